@@ -1,5 +1,6 @@
 from Resources import RobotResources, CircleResources
 from Models.EllipseModels import Ellipse, RobotEllipse
+from EventLog import EventLog
 
 import copy
 import numpy as np
@@ -10,8 +11,8 @@ from numpy.linalg import norm
 
 
 class CameraCalibration:
-    def __init__(self):
-        pass
+    def __init__(self, event_log = None):
+        self.event_log = event_log if event_log != None else EventLog()
 
     def calibrate(self, camera, robot_ellipses, circle_resources):
         if len(robot_ellipses) < 3:
@@ -25,7 +26,7 @@ class CameraCalibration:
         camera_position = self._calculate_camera_position(coordinate_ellipses)
         camera.set_position(camera_position)
 
-        print(camera_position)
+        self.event_log.info(None, "%s: position %s", camera.get_name(), camera_position)
         #Calculate the camera's angle
         camera_angle = self._calculate_camera_angle(camera, coordinate_ellipses, circle_resources)    #Hard to test? How to test?
         camera.set_angle_to_floor(camera_angle, 'rad')
@@ -34,8 +35,7 @@ class CameraCalibration:
         camera_rotation = self._calculate_camera_rotation(camera, coordinate_ellipses)
         camera.set_rotation_from_center(camera_rotation, 'rad')
 
-        print("Angle: " + str(camera.get_angle_to_floor()))
-        print("Rotation: " + str(camera.get_rotation_from_center()))
+        self.event_log.info(None, "%s: angle %s, rotation %s", camera.get_name(), camera.get_angle_to_floor(), camera.get_rotation_from_center())
 
 
     def _get_ellipse_coordinates(self, ellipses, circle_resources):
@@ -196,9 +196,7 @@ class CameraCalibration:
         distance_1 = estimated_distance_1
         distance_2 = estimated_distance_2
 
-        print("Distance1: " + str(distance_1))
-        print("Height: "+ str(camera.get_position()[2]))
-        print("Distance1: " + str(distance_2))
+        self.event_log.debug(None, "%s: distance 1 %s, height %s, distance 2 %s", camera.get_name(), distance_1, camera.get_position()[2], distance_2)
 
         v_1 = math.asin(camera.get_position()[2] / distance_1)
         v_2 = math.asin(camera.get_position()[2] / distance_2)
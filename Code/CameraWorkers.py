@@ -0,0 +1,114 @@
+import threading
+import multiprocessing
+import queue
+import time
+
+
+
+class CameraWorker:
+    #Runs detect(cam) over and over for one camera and keeps only the latest result, so a slow or stalled camera never holds
+    #up the reader. mode 'thread' calls detect in a daemon thread of this process, 'process' in a spawned process: there
+    #detect and cam are pickled, so detect must be a picklable callable and the camera must be able to reopen itself
+    def __init__(self, cam, detect, mode = 'thread', retry_delay = 0.1):
+        if mode not in ('thread', 'process'):
+            raise Exception("Unknown camera worker mode: " + str(mode))
+        self.cam_name = cam.get_name()
+        self._mode = mode
+        self._latest = None                                                     #{ 'result', 'time': capture start (time.time()), 'frames': results so far }
+        self._error = None
+        self._lock = threading.Lock()
+        if mode == 'thread':
+            self._stop_event = threading.Event()
+            self._worker = threading.Thread(target = _run_camera_worker, args = (cam, detect, self._publish, self._stop_event, retry_delay),
+                                            name = 'camera-' + self.cam_name, daemon = True)
+        else:
+            context = multiprocessing.get_context('spawn')                      #The same on every platform, nothing but the arguments is shared
+            self._stop_event = context.Event()
+            self._results = context.Queue(maxsize = 1)
+            self._worker = context.Process(target = _run_camera_process, args = (cam, detect, self._results, self._stop_event, retry_delay),
+                                           name = 'camera-' + self.cam_name, daemon = True)
+
+    def start(self):
+        self._worker.start()
+        return self
+
+    def stop(self, timeout = 2.0):
+        self._stop_event.set()
+        self._worker.join(timeout)
+        if self._mode == 'process' and self._worker.is_alive():                 #Stuck in a capture, a thread can only be abandoned
+            self._worker.terminate()
+
+    def is_alive(self):
+        return self._worker.is_alive()
+
+    def get_latest(self):
+        if self._mode == 'process':
+            self._drain_results()
+        with self._lock:
+            return self._latest
+
+    def get_status(self):
+        #{ 'age': seconds since the latest result's frame was captured (None before the first), 'frames', 'alive', 'error' }
+        latest = self.get_latest()
+        with self._lock:
+            error = self._error
+        return { 'age': time.time() - latest['time'] if latest != None else None, 'frames': latest['frames'] if latest != None else 0,
+                 'alive': self.is_alive(), 'error': error }
+
+    def _publish(self, latest, error):
+        with self._lock:
+            if latest != None:
+                self._latest = latest
+            self._error = error
+
+    def _drain_results(self):
+        while True:
+            try:
+                latest, error = self._results.get_nowait()
+            except queue.Empty:
+                return
+            self._publish(latest, error)
+
+
+
+
+
+
+
+def _run_camera_worker(cam, detect, publish, stop_event, retry_delay):
+    frames = 0
+    while not stop_event.is_set():
+        capture_time = time.time()
+        try:
+            result = detect(cam)
+        except Exception as exception:                                          #Reported in the status, the camera is tried again
+            publish(None, repr(exception))
+            stop_event.wait(retry_delay)
+            continue
+        frames += 1
+        publish({ 'result': result, 'time': capture_time, 'frames': frames }, None)
+
+def _run_camera_process(cam, detect, results, stop_event, retry_delay):
+    def publish(latest, error):
+        try:                                                                    #Only the newest result waits in the queue
+            results.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            results.put_nowait((latest, error))
+        except queue.Full:
+            pass
+    _run_camera_worker(cam, detect, publish, stop_event, retry_delay)
+
+
+
+
+
+
+
+
+
+
+
+
+#Nothing
@@ -2,32 +2,300 @@ from Models.EllipseModels import *
 
 from skimage import measure
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import math
+import time
+import threading
 import cv2
 
 
 
 class EllipseDetection:
-    def __init__(self, ellipse_threshold = 50):
-        self._ellipse_error_threshold = ellipse_threshold
-
-    def detect(self, image):
+    def __init__(self, ellipse_threshold = 50, edge_extraction = 'array', fitting = 'batch', filter_stages = None, edge_retention = 'full', edge_decimation = 8,
+                 pyramid_depth = 1, pyramid_min_size = 8, refit_band = 3):
+        self._ellipse_error_threshold, self._residual = self._parse_ellipse_threshold(ellipse_threshold)
+        self._edge_extraction = edge_extraction                                 #'array': one (N, 2) numpy array per edge, 'list': [[row, col], ...] per edge
+        self._fitting = fitting                                                 #'batch': all edges of a frame in one EllipseBatchFitting call, 'single': one edge at a time
+        self._batch_fitting = EllipseBatchFitting()
+        self._edge_retention = edge_retention                                   #What detected ellipses keep of their edge pixels: 'full', 'decimated' (every edge_decimation'th pixel) or 'none'
+        self._edge_decimation = edge_decimation
+        self._pyramid_depth = pyramid_depth                                     #1: full resolution only, N: search on pyramid levels 1..N-1 and refit at full resolution
+        self._pyramid_min_size = pyramid_min_size                               #Smallest max_size (in pixels of the level) searched on a level, a number or one value per level
+        self._refit_band = refit_band                                           #Half width in full resolution pixels of the band searched around a coarse ellipse
+        self._filter_stages = []
+        self._filter_statistics = {}
+        self._statistics_lock = threading.Lock()                                #detect can run in several threads on one detector
+        self.set_filter_stages(filter_stages if filter_stages is not None else self.get_default_filter_stages())
+
+    def _parse_ellipse_threshold(self, ellipse_threshold):
+        #A plain number keeps the original 'radius' measure, e.g. { 'residual': 'sampson', 'threshold': 1.5 } selects another one
+        if isinstance(ellipse_threshold, dict):
+            return ellipse_threshold['threshold'], ellipse_threshold.get('residual', 'radius').lower()
+        return ellipse_threshold, 'radius'
+
+    def get_default_filter_stages(self):
+        #'cost' is a relative estimate per ellipse, the cascade runs the cheapest stages first
+        return [{ 'name': 'ratio',  'cost': 1,   'filter': self._filter_ratio },
+                { 'name': 'size',   'cost': 1,   'filter': self._filter_size },
+                { 'name': 'border', 'cost': 2,   'filter': self._filter_screen_border },
+                { 'name': 'error',  'cost': 100, 'filter': self._filter_error }]
+
+    def set_filter_stages(self, filter_stages):
+        #Each stage is { 'name': str, 'cost': number, 'filter': function(ellipse, image_shape) -> bool }
+        self._filter_stages = sorted(filter_stages, key=lambda stage: stage['cost'])
+        self.reset_filter_statistics()
+
+    def get_filter_stages(self):
+        return list(self._filter_stages)
+
+    def get_filter_statistics(self):
+        with self._statistics_lock:
+            return { name: dict(statistics) for name, statistics in self._filter_statistics.items() }
+
+    def reset_filter_statistics(self):
+        with self._statistics_lock:
+            self._filter_statistics = { stage['name']: { 'checked': 0, 'rejected': 0, 'time': 0.0 } for stage in self._filter_stages }
+
+    def add_filter_statistics(self, filter_statistics):
+        with self._statistics_lock:
+            _merge_filter_statistics(self._filter_statistics, filter_statistics)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_statistics_lock']                                           #Locks can not be pickled (process pools)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._statistics_lock = threading.Lock()
+
+    def get_pyramid_depth(self):
+        return self._pyramid_depth
+
+    def detect(self, image, pyramid = None):
+        if self._pyramid_depth > 1:
+            return self._detect_coarse_to_fine(image, pyramid)
+        return self._detect_full_resolution(image)
+
+    def _detect_full_resolution(self, image):
         edge_image = self._edge_detection_and_linking(image)
         edges = self._find_individual_edges(edge_image)
-        ellipses = self._detect_ellipses(edges, image)
+        ellipses = self._detect_ellipses(edges, image.shape)
+        return ellipses
+
+    def _detect_coarse_to_fine(self, image, pyramid = None):
+        #pyramid is [image, pyrDown(image), ...] (e.g. FrameContext.pyramid), it is built here when not given. A refit only
+        #sees the edges in a window around its candidate, so an ellipse whose edge runs into other edges beyond it (a
+        #cluttered frame) is not refitted. Then the frame is detected at full resolution instead, which costs the
+        #pyramid search on top of detect() but keeps its recall
+        if pyramid is None or len(pyramid) < self._pyramid_depth:
+            pyramid = [image]
+            while len(pyramid) < self._pyramid_depth:
+                pyramid.append(cv2.pyrDown(pyramid[-1]))
+        coarse_ellipses = []
+        for level in range(1, self._pyramid_depth):
+            level_ellipses = self._find_coarse_ellipses(pyramid[level], level)
+            coarse_ellipses.extend(self._remove_found_ellipses(level_ellipses, coarse_ellipses, 2**level))
+        ellipses = self.refit(image, coarse_ellipses)
+        if len(ellipses) < len(coarse_ellipses):
+            min_size = min(self._get_pyramid_min_size(level) * 2**level for level in range(1, self._pyramid_depth))
+            return [ellipse for ellipse in self._detect_full_resolution(image) if ellipse.max_size() >= min_size]
         return ellipses
 
+    def _remove_found_ellipses(self, ellipses, found_ellipses, tolerance):
+        #Drops the ellipses a finer level already found, within the pixel size (tolerance) of the coarser level
+        if len(found_ellipses) == 0:
+            return ellipses
+        found_centers = np.array([ellipse.center() for ellipse in found_ellipses])
+        found_sizes = np.array([ellipse.max_size() for ellipse in found_ellipses])
+        new_ellipses = []
+        for ellipse in ellipses:
+            center_distances = np.hypot(found_centers[:, 0] - ellipse.center('x'), found_centers[:, 1] - ellipse.center('y'))
+            if not np.any((center_distances <= tolerance) & (np.abs(found_sizes - ellipse.max_size()) <= tolerance)):
+                new_ellipses.append(ellipse)
+        return new_ellipses
+
+    def _find_coarse_ellipses(self, level_image, level):
+        edge_image = self._edge_detection_and_linking(level_image)
+        edges = self._find_individual_edges(edge_image)
+        scale = 2**level
+        min_size = self._get_pyramid_min_size(level)
+        coarse_ellipses = []
+        for ellipse in self._find_all_ellipses(edges):
+            if ellipse.max_size() >= min_size and self._filter_ratio(ellipse):
+                center = (ellipse.center('x') * scale, ellipse.center('y') * scale)
+                coarse_ellipses.append(Ellipse([], center, ellipse.width() * scale, ellipse.height() * scale, ellipse.rotation(), None))
+        return coarse_ellipses
+
+    def _get_pyramid_min_size(self, level):
+        if isinstance(self._pyramid_min_size, (list, tuple)):
+            return self._pyramid_min_size[level]
+        return self._pyramid_min_size
+
+    def refit(self, image, ellipses, band = None):
+        #Fits approximate ellipses (full resolution coordinates) again on the edges of image near them. The connected edges
+        #with pixels between min_size - band and max_size + band from an ellipse's center are fitted and the one closest
+        #to the approximate ellipse replaces it. Edges are found per window around each ellipse, or once for the whole
+        #image when the windows together are bigger than it
+        if band is None:
+            band = self._refit_band
+        windows = [self._refit_window(image.shape, ellipse, band) for ellipse in ellipses]
+        window_area = sum((last_row - first_row) * (last_column - first_column) for first_row, last_row, first_column, last_column in windows)
+        if window_area > image.shape[0] * image.shape[1]:
+            candidate_edges, candidate_owners = self._find_edges_in_bands(image, ellipses, band)
+        else:
+            candidate_edges, candidate_owners = self._find_edges_in_windows(image, ellipses, windows, band)
+        refit_candidates, valid_indices = self._fit_edges_in_batch(candidate_edges)
+        owner_candidates = {}
+        for candidate, index in zip(refit_candidates, valid_indices):
+            for owner in candidate_owners[index]:
+                owner_candidates.setdefault(owner, []).append(candidate)
+        refit_ellipses = []
+        chosen_candidates = set()
+        for owner, ellipse in enumerate(ellipses):
+            closest = self._find_closest_refit(ellipse, owner_candidates.get(owner, []))
+            if closest is not None and closest not in chosen_candidates:        #Two coarse ellipses can find the same edge
+                chosen_candidates.add(closest)
+                refit_ellipses.append(closest)
+        ellipses = self._filter_ellipses(refit_ellipses, image.shape)
+        self._release_edge_pixels(ellipses)
+        return ellipses
+
+    def _refit_window(self, image_shape, ellipse, band):
+        outer = ellipse.max_size() + band
+        center_row, center_column = ellipse.center()
+        first_row = min(max(int(center_row - outer) - 2, 0), image_shape[0])
+        last_row = max(min(int(center_row + outer) + 3, image_shape[0]), first_row)
+        first_column = min(max(int(center_column - outer) - 2, 0), image_shape[1])
+        last_column = max(min(int(center_column + outer) + 3, image_shape[1]), first_column)
+        return (first_row, last_row, first_column, last_column)
+
+    def _find_edges_in_windows(self, image, ellipses, windows, band):
+        candidate_edges = []
+        candidate_owners = []
+        for window, window_owners in self._merge_windows(windows):              #Overlapping windows (e.g. both edges of a ring) are searched once
+            first_row, last_row, first_column, last_column = window
+            if last_row - first_row < 3 or last_column - first_column < 3:
+                continue
+            edge_image = self._edge_detection_and_linking(image[first_row:last_row, first_column:last_column])
+            for edge in self._find_individual_edges(edge_image):
+                edge_array = np.asarray(edge) + (first_row, first_column)
+                owners = tuple(owner for owner in window_owners if self._edge_in_band(edge_array, ellipses[owner], band))
+                if len(owners) > 0:
+                    candidate_edges.append(edge_array)
+                    candidate_owners.append(owners)
+        return candidate_edges, candidate_owners
+
+    def _merge_windows(self, windows):
+        merged_windows = [(window, [owner]) for owner, window in enumerate(windows)]
+        merged = True
+        while merged:
+            merged = False
+            for first in range(len(merged_windows)):
+                for second in range(first + 1, len(merged_windows)):
+                    window_a, owners_a = merged_windows[first]
+                    window_b, owners_b = merged_windows[second]
+                    if window_a[0] < window_b[1] and window_b[0] < window_a[1] and window_a[2] < window_b[3] and window_b[2] < window_a[3]:
+                        union = (min(window_a[0], window_b[0]), max(window_a[1], window_b[1]), min(window_a[2], window_b[2]), max(window_a[3], window_b[3]))
+                        merged_windows[first] = (union, owners_a + owners_b)
+                        del merged_windows[second]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return merged_windows
+
+    def _find_edges_in_bands(self, image, ellipses, band):
+        #Same edges as detect() would use, but only the ones in the band of at least one ellipse are kept
+        edge_image = self._edge_detection_and_linking(image)
+        ellipse_index = EllipseSpatialIndex(ellipses)
+        candidate_edges = []
+        candidate_owners = []
+        for edge in self._find_individual_edges(edge_image):
+            edge_array = np.asarray(edge)
+            edge_min = edge_array.min(axis=0)
+            edge_max = edge_array.max(axis=0)
+            reach = np.hypot(*(edge_max - edge_min)) / 2 + band                 #Bounding circle of the edge, grown by the band
+            owners = tuple(owner for owner in ellipse_index.indices_within((edge_min + edge_max) / 2, reach) if self._edge_in_band(edge_array, ellipses[owner], band))
+            if len(owners) > 0:
+                candidate_edges.append(edge_array)
+                candidate_owners.append(owners)
+        return candidate_edges, candidate_owners
+
+    def _edge_in_band(self, edge_array, ellipse, band):
+        outer = ellipse.max_size() + band
+        inner = max(ellipse.min_size() - band, 0)
+        distances = np.hypot(edge_array[:, 0] - ellipse.center('x'), edge_array[:, 1] - ellipse.center('y'))
+        return np.any((distances >= inner) & (distances <= outer))
+
+    def _find_closest_refit(self, ellipse, candidates):
+        closest = None
+        closest_difference = math.inf
+        for candidate in candidates:
+            difference = math.hypot(candidate.center('x') - ellipse.center('x'), candidate.center('y') - ellipse.center('y')) + \
+                         abs(candidate.max_size() - ellipse.max_size()) + abs(candidate.min_size() - ellipse.min_size())
+            if difference < closest_difference:
+                closest = candidate
+                closest_difference = difference
+        return closest
+
+    def detect_in_tile(self, tile_image, tile, image_shape, border_margin = 3, filter_statistics = None):
+        #Detection for one tile of a larger image (see TiledEllipseDetection). Canny output depends on a pixel's close
+        #neighbourhood only, so edges at least border_margin pixels from a cut border are the same as in the full image.
+        #The filter counts go to filter_statistics if given, else to the detector's own
+        edge_image = self._edge_detection_and_linking(tile_image)
+        edges = self._find_individual_edges(edge_image, lambda pure_edges: self._select_tile_edges(pure_edges, tile, image_shape, border_margin))
+        ellipses = self._detect_ellipses(edges, image_shape, filter_statistics)
+        return ellipses
+
+    def _select_tile_edges(self, pure_edges, tile, image_shape, border_margin):
+        first_row, last_row, first_column, last_column = tile['window']
+        core_first_row, core_last_row, core_first_column, core_last_column = tile['core']
+        lowest_row = 0 if first_row == 0 else border_margin
+        lowest_column = 0 if first_column == 0 else border_margin
+        highest_row = (last_row - first_row) - (0 if last_row == image_shape[0] else border_margin)
+        highest_column = (last_column - first_column) - (0 if last_column == image_shape[1] else border_margin)
+        tile_edges = []
+        for edge in pure_edges:
+            edge_array = np.asarray(edge)
+            edge_min = edge_array.min(axis=0)
+            edge_max = edge_array.max(axis=0)
+            if edge_min[0] < lowest_row or edge_min[1] < lowest_column or edge_max[0] >= highest_row or edge_max[1] >= highest_column:
+                continue                                                        #Cut by the window, a neighbouring tile has all of it
+            owner_row = edge_array[0][0] + first_row
+            owner_column = edge_array[0][1] + first_column
+            if core_first_row <= owner_row < core_last_row and core_first_column <= owner_column < core_last_column:
+                tile_edges.append(edge_array + (first_row, first_column))
+        return tile_edges
+
     def _edge_detection_and_linking(self, image):                               #(y)
         return cv2.Canny(image, 100, 200)
 
-    def _find_individual_edges(self, edge_image):                               #(y)
+    def _find_individual_edges(self, edge_image, edge_selection = None):       #(y)
         labels = measure.label(edge_image)
         edges = self._find_edges_from_labels(labels)
         pure_edges = self._convert_to_pure_edges(edges)
+        if edge_selection is not None:
+            pure_edges = edge_selection(pure_edges)
         filtered_pure_edges = self._edge_filtering(pure_edges)
         return filtered_pure_edges
 
-    def _find_edges_from_labels(self, labels):                                  #!
+    def _find_edges_from_labels(self, labels):
+        if self._edge_extraction.lower() == 'list':
+            return self._find_edge_lists_from_labels(labels)
+        return self._find_edge_arrays_from_labels(labels)
+
+    def _find_edge_arrays_from_labels(self, labels):
+        edge_coors = np.argwhere(labels)                                        #Row-major order, same as walking the label image pixel by pixel
+        edge_labels = labels[edge_coors[:, 0], edge_coors[:, 1]]
+        order = np.argsort(edge_labels, kind='stable')                          #Stable sort keeps the row-major order inside each edge
+        edge_coors = edge_coors[order]
+        edge_labels = edge_labels[order]
+        label_values, label_starts = np.unique(edge_labels, return_index=True)
+        edge_groups = np.split(edge_coors, label_starts[1:])
+        return dict(zip(label_values, edge_groups))                             #measure.label numbers edges in raster order, so keys come in the same order as the list version
+
+    def _find_edge_lists_from_labels(self, labels):
         edges = {}
         for label_nr, label in enumerate(labels):
             for element_nr, element in enumerate(label):
@@ -43,20 +311,49 @@ class EllipseDetection:
         filtered_edges = []
         for edge in pure_edges:
             if len(edge) > 10:
-             diff_list_x = [abs(edge[count][0] - edge[count+1][0]) for count in range(0, len(edge)-1)]
-             diff_list_y = [abs(edge[count][1] - edge[count+1][1]) for count in range(0, len(edge)-1)]
-             diff_norm_x = sum(diff_list_x) / len(edge)
-             diff_norm_y = sum(diff_list_y) / len(edge)
-             if diff_norm_x >= 0.2 and diff_norm_y >= 0.2:
-                 filtered_edges.append(edge)
+                diff_sum = np.abs(np.diff(np.asarray(edge), axis=0)).sum(axis=0)
+                diff_norm_x = diff_sum[0] / len(edge)
+                diff_norm_y = diff_sum[1] / len(edge)
+                if diff_norm_x >= 0.2 and diff_norm_y >= 0.2:
+                    filtered_edges.append(edge)
         return filtered_edges
 
-    def _detect_ellipses(self, edges, image):
+    def _detect_ellipses(self, edges, image_shape, filter_statistics = None):
         all_ellipses = self._find_all_ellipses(edges)
-        ellipses = self._filter_ellipses(all_ellipses, image)
+        ellipses = self._filter_ellipses(all_ellipses, image_shape, filter_statistics)
+        self._release_edge_pixels(ellipses)
         return ellipses
 
+    def _release_edge_pixels(self, ellipses):
+        if self._edge_retention.lower() == 'full':
+            return
+        step = self._edge_decimation if self._edge_retention.lower() == 'decimated' else 0
+        batch_indices = {}
+        for ellipse in ellipses:
+            if isinstance(ellipse, EllipseView):
+                batch_indices.setdefault(id(ellipse.batch()), (ellipse.batch(), []))[1].append(ellipse.batch_index())
+            else:
+                ellipse.release_edge_pixels(step)
+        for batch, indices in batch_indices.values():                           #One rebuild per batch, the rejected ellipses' pixels go with it
+            batch.release_edges(indices, step)
+
     def _find_all_ellipses(self, edges):
+        if self._fitting.lower() == 'single':
+            return self._find_all_ellipses_single(edges)
+        return self._find_all_ellipses_batch(edges)
+
+    def _find_all_ellipses_batch(self, edges):
+        ellipses, _ = self._fit_edges_in_batch(edges)
+        return ellipses
+
+    def _fit_edges_in_batch(self, edges):
+        fit = self._batch_fitting.fit(edges)
+        valid_indices = np.flatnonzero(fit['valid'])                            #Degenerate fits would get width 1 and height 1000 and never pass the ratio filter
+        batch = EllipseBatch(fit['center'][valid_indices], fit['width'][valid_indices], fit['height'][valid_indices], fit['rotation'][valid_indices],
+                             [edges[index] for index in valid_indices], fit['conic'][valid_indices])
+        return batch.views(), valid_indices
+
+    def _find_all_ellipses_single(self, edges):
         ellipse_list = []
         for edge in edges:
             ellipse = self._ellipse_detection(edge)
@@ -67,9 +364,7 @@ class EllipseDetection:
         original_ellipse = self._calculate_ellipse_from_edge(edge)
         centered_edge = [[coor[0] - original_ellipse.center('x'), coor[1] - original_ellipse.center('y')] for coor in edge]
         centered_ellipse = self._calculate_ellipse_from_edge(centered_edge)
-        original_ellipse.width = centered_ellipse.width
-        original_ellipse.height = centered_ellipse.height
-        return original_ellipse
+        return Ellipse(edge, original_ellipse.center(), centered_ellipse.width(), centered_ellipse.height(), original_ellipse.rotation(), original_ellipse.conic())
 
     def _calculate_ellipse_from_edge(self, edge):                                         #!
         a_matrix = self._calculate_a_matrix(edge)
@@ -81,7 +376,7 @@ class EllipseDetection:
         rotation = self._calculate_ellipse_rotation(result_matrix)
         width = self._calculate_ellipse_width(result_matrix, center)
         height = self._calculate_ellipse_height(result_matrix, center)
-        return Ellipse(edge, center, width, height, rotation)
+        return Ellipse(edge, center, width, height, rotation, result_matrix[:, 0])
 
     def _calculate_ellipse_rotation(self, result_matrix):
         if (result_matrix[0][0]-1) != 0:
@@ -152,18 +447,23 @@ class EllipseDetection:
             y_approx = 9999
         return y_approx
 
-    def _filter_ellipses(self, ellipses, image):
-        valid_ellipse_list = []
-        for ellipse in ellipses:
-            if self._ellipse_filtering(ellipse, image):
-                valid_ellipse_list.append(ellipse)
+    def _filter_ellipses(self, ellipses, image_shape, filter_statistics = None):
+        valid_ellipse_list = ellipses
+        stage_statistics = {}
+        for stage in self._filter_stages:                                       #Stage by stage, so each stage only sees the survivors of the cheaper ones
+            start_time = time.perf_counter()
+            passed_ellipse_list = [ellipse for ellipse in valid_ellipse_list if stage['filter'](ellipse, image_shape)]
+            stage_statistics[stage['name']] = { 'checked': len(valid_ellipse_list), 'rejected': len(valid_ellipse_list) - len(passed_ellipse_list),
+                                                'time': time.perf_counter() - start_time }
+            valid_ellipse_list = passed_ellipse_list
+        if filter_statistics is None:
+            self.add_filter_statistics(stage_statistics)
+        else:
+            _merge_filter_statistics(filter_statistics, stage_statistics)
         return valid_ellipse_list
 
     def _ellipse_filtering(self, ellipse, image):
-        return  self._filter_ratio(ellipse) and \
-                self._filter_error(ellipse) and \
-                self._filter_size(ellipse, image.shape) and \
-                self._filter_screen_border(ellipse, image.shape)
+        return all(stage['filter'](ellipse, image.shape) for stage in self._filter_stages)
 
     def _filter_screen_border(self, ellipse, image_shape):
         if ellipse.center('x') - ellipse.max_size() < 0 or ellipse.center('x') + ellipse.max_size() > image_shape[1]:
@@ -173,64 +473,219 @@ class EllipseDetection:
         else:
             return True
 
-    def _filter_error(self, ellipse):
-        error = self._error_least_square(ellipse)
+    def _filter_error(self, ellipse, image_shape = None):
+        if self._residual == 'sampson':
+            error = self._error_sampson(ellipse)
+        else:
+            error = self._error_least_square(ellipse)
         return error < self._ellipse_error_threshold
 
-    def _error_least_square(self, ellipse):                                     #!
-        full_error = 0
-        for edge_pixel in ellipse.edge_pixels():
-            angle = self._calculate_ellipse_angle_from_pixel(ellipse, edge_pixel)
-            ellipse_coor_1, ellipse_coor_2 = self._calculate_ellipse_coor_from_angle(ellipse, angle)
-            full_error += self._calculate_minimum_ellipse_error(ellipse, [ellipse_coor_1, ellipse_coor_2])
-        normalized_error = full_error / len(ellipse.edge_pixels())
-        return normalized_error
+    #Threshold mapping for the residuals selectable through ellipse_threshold:
+    #   'radius'  (default, plain number): the original per pixel measure. For each edge pixel the ellipse point on the
+    #             line through the center and the pixel is found and its distance to the center is used, i.e. the
+    #             ellipse radius at the pixel's angle, averaged over the edge. Closed form per pixel with v = center - pixel:
+    #                 r = width * height * |v| / sqrt(height^2 * v_x^2 + width^2 * v_y^2)
+    #             The rotation cancels out, so this gives the same value as the old loop and existing thresholds like
+    #             SpecialEllipses(125) keep their meaning (a bound on the mean radius in pixels).
+    #   'sampson': mean first order geometric distance in pixels from the edge pixels to the fitted conic. This is a
+    #             real fitting error and does not scale with the ellipse size, so the threshold is a few pixels
+    #             (about 1-2 for clean Canny edges), not the radius based values above.
+    def _error_least_square(self, ellipse):
+        vectors = np.asarray(ellipse.center(), dtype=np.float64) - np.asarray(ellipse.edge_pixels(), dtype=np.float64)
+        a = ellipse.width()
+        b = ellipse.height()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            radius_at_pixels = (a * b * np.hypot(vectors[:, 0], vectors[:, 1])) / np.sqrt(b**2 * vectors[:, 0]**2 + a**2 * vectors[:, 1]**2)
+        return np.mean(radius_at_pixels)
+
+    def _error_sampson(self, ellipse):
+        if ellipse.conic() is None:
+            return math.inf
+        r0, r1, r2, r3, r4 = ellipse.conic()
+        coors = np.asarray(ellipse.edge_pixels(), dtype=np.float64)
+        x = coors[:, 0]
+        y = coors[:, 1]
+        conic_value = r0*x*x + 2*r1*x*y + y*y - 2*r2*x - 2*r3*y - r4
+        gradient_x = 2*r0*x + 2*r1*y - 2*r2
+        gradient_y = 2*r1*x + 2*y - 2*r3
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.abs(conic_value) / np.hypot(gradient_x, gradient_y)
+        return np.mean(distances)
+
+
+    def _filter_ratio(self, ellipse, image_shape = None):
+        ratio =  ellipse.ratio()
+        return ratio < 50 and ratio > 0.02
 
-    def _calculate_ellipse_angle_from_pixel(self, ellipse, edge_pixel):
-        vector = [ellipse.center()[0] - edge_pixel[0], ellipse.center()[1] - edge_pixel[1]]   #Find the vector going through the coordinate and the ellipse center coordinate
-        hypotenuse = math.sqrt(vector[0]**2 + vector[1]**2)                             #From now on is the center coordinates [0, 0] because of the centralization that also happens when substracting
-        vector_angle = math.asin(vector[1] / hypotenuse)
-        return vector_angle
+    def _filter_size(self, ellipse, image_size):
+        return ellipse.height() < image_size[0] and ellipse.width() < image_size[1]
 
 
-    def _calculate_ellipse_coor_from_angle(self, ellipse, angle):               #!
-        #Find the two places where the vector is intersecting with the ellipse, rotate them, push them back to the right center and calculate the error
-        a = ellipse.width()
-        b = ellipse.height()
-        #Find ellipse edge coordinate based on angle
-        calc_edge_coor_x_1 = (a * b) / math.sqrt(b**2 + (a**2 * math.tan(angle)**2))
-        calc_edge_coor_y_1 = calc_edge_coor_x_1 * math.tan(angle)
-        #Determine which Point
-        if angle <= 90 or angle > 270: pass
-        else:
-            calc_edge_coor_x_1 =   -calc_edge_coor_x_1
-            calc_edge_coor_y_1 =   -calc_edge_coor_y_1
-        calc_edge_coor_x_2 = -calc_edge_coor_x_1
-        calc_edge_coor_y_2 = -calc_edge_coor_y_1
 
-        ellipse_coor_1 = (calc_edge_coor_x_1, calc_edge_coor_y_1)
-        ellipse_coor_2 = (calc_edge_coor_x_2, calc_edge_coor_y_2)
-        return ellipse_coor_1, ellipse_coor_2
 
 
-    def _calculate_minimum_ellipse_error(self, ellipse, ellipse_coor_list):     #!
-        error_list = []
-        for ellipse_coor in ellipse_coor_list:
-            x_rotated = math.cos(ellipse.rotation('rad')) * ellipse_coor[0] - math.sin(ellipse.rotation('rad')) * ellipse_coor[1]
-            y_rotated = math.sin(ellipse.rotation('rad')) * ellipse_coor[0] + math.cos(ellipse.rotation('rad')) * ellipse_coor[1]
-            x_rotated_pushed_back = x_rotated + ellipse.center()[0]
-            y_rotated_pushed_back =  y_rotated + ellipse.center()[1]
-            error = math.sqrt((x_rotated_pushed_back - ellipse.center()[0])**2 + (y_rotated_pushed_back - ellipse.center()[1])**2)
-            error_list.append(error)
-        return max(error_list)
 
 
-    def _filter_ratio(self, ellipse):
-        ratio =  ellipse.ratio()
-        return ratio < 50 and ratio > 0.02
+def _merge_filter_statistics(statistics, added_statistics):
+    for name, added in added_statistics.items():
+        stage_statistics = statistics.setdefault(name, { 'checked': 0, 'rejected': 0, 'time': 0.0 })
+        for key in stage_statistics:
+            stage_statistics[key] += added[key]
+
+def _detect_ellipses_in_tile(ellipse_detector, tile_image, tile, image_shape):
+    #Runs in a pool worker, see TiledEllipseDetection. The counts of each tile are kept apart, threads share the detector
+    filter_statistics = {}
+    ellipses = ellipse_detector.detect_in_tile(tile_image, tile, image_shape, filter_statistics = filter_statistics)
+    return ellipses, filter_statistics
+
+
+
+class TiledEllipseDetection:
+    #Splits the image into tiles and runs the detection of each tile in a worker pool. Every tile is extended by a halo
+    #on all sides (the tile's window). A tile only keeps the connected edges that lie completely inside its window, away
+    #from the window border, and whose first pixel is in its core. Every edge that fits into a window is therefore
+    #handled by exactly one tile, with the same pixels as in the full image. The result matches EllipseDetection.detect
+    #on the whole image only if the halo covers the biggest connected edge (its bounding box), not just the biggest
+    #ellipse: an ellipse whose edge runs into other edges (e.g. a marker on a cluttered background) is part of a much
+    #bigger component, and a component that no window holds completely is lost
+    def __init__(self, ellipse_detector, tile_size = 512, halo = 128, workers = None, executor = 'process'):
+        self.ellipse_detector = ellipse_detector
+        self._tile_size = tile_size
+        self._halo = halo
+        self._workers = workers
+        self._executor_type = executor                                         #'process' or 'thread'
+        self._executor = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self._executor_type.lower() == 'thread':
+                self._executor = ThreadPoolExecutor(max_workers=self._workers)
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        return self._executor
+
+    def detect(self, image):
+        tiles = self._split_into_tiles(image.shape)
+        executor = self._get_executor()
+        futures = []
+        for tile in tiles:
+            first_row, last_row, first_column, last_column = tile['window']
+            tile_image = image[first_row:last_row, first_column:last_column]
+            futures.append(executor.submit(_detect_ellipses_in_tile, self.ellipse_detector, tile_image, tile, image.shape))
+        ellipses = []
+        for future in futures:
+            tile_ellipses, filter_statistics = future.result()
+            ellipses.extend(tile_ellipses)
+            self.ellipse_detector.add_filter_statistics(filter_statistics)
+        return ellipses
+
+    def _split_into_tiles(self, image_shape):
+        tiles = []
+        for first_row in range(0, image_shape[0], self._tile_size):
+            for first_column in range(0, image_shape[1], self._tile_size):
+                last_row = min(first_row + self._tile_size, image_shape[0])
+                last_column = min(first_column + self._tile_size, image_shape[1])
+                window = (max(first_row - self._halo, 0), min(last_row + self._halo, image_shape[0]),
+                          max(first_column - self._halo, 0), min(last_column + self._halo, image_shape[1]))
+                tiles.append({ 'core': (first_row, last_row, first_column, last_column), 'window': window })
+        return tiles
 
-    def _filter_size(self, ellipse, image_size):
-        return ellipse.height() < image_size[0] and ellipse.width() < image_size[1]
+
+
+
+
+
+
+class EllipseBatchFitting:
+    #Same least square model as EllipseDetection._calculate_ellipse_from_edge:
+    #   x^2*r0 + 2xy*r1 - 2x*r2 - 2y*r3 - r4 = -y^2
+    #but every edge's 5x5 normal equation is summed and solved in one stacked numpy call
+    def fit(self, edges):
+        if len(edges) == 0:
+            return self._empty_result()
+        edge_lengths = np.array([len(edge) for edge in edges])
+        edge_starts = np.concatenate(([0], np.cumsum(edge_lengths)[:-1]))
+        coors = np.concatenate([np.asarray(edge, dtype=np.float64).reshape(-1, 2) for edge in edges])
+
+        result, valid = self._solve_least_square(coors, edge_starts)
+        center = self._calculate_center_coor_approx(result)
+        rotation = self._calculate_ellipse_rotation(result)
+
+        #Refit on the centered edges to get the width and height (as EllipseDetection._ellipse_detection)
+        centered_coors = coors - np.repeat(center, edge_lengths, axis=0)
+        centered_result, centered_valid = self._solve_least_square(centered_coors, edge_starts)
+        centered_center = self._calculate_center_coor_approx(centered_result)
+        width = self._calculate_ellipse_width(centered_result, centered_center)
+        height = self._calculate_ellipse_height(centered_result, centered_center)
+
+        return { 'center': center, 'width': width, 'height': height, 'rotation': rotation, 'conic': result, 'valid': valid & centered_valid }
+
+    def _empty_result(self):
+        return { 'center': np.zeros((0, 2)), 'width': np.zeros(0), 'height': np.zeros(0), 'rotation': np.zeros(0), 'conic': np.zeros((0, 5)), 'valid': np.zeros(0, dtype=bool) }
+
+    def _solve_least_square(self, coors, edge_starts):
+        x = coors[:, 0]
+        y = coors[:, 1]
+        a_columns = [x*x, 2*x*y, -2*x, -2*y, -np.ones_like(x)]
+        b_column = -y*y
+
+        nr_of_edges = len(edge_starts)
+        a_multiplied = np.empty((nr_of_edges, 5, 5))
+        aTb_multiplied = np.empty((nr_of_edges, 5, 1))
+        for row in range(5):
+            for column in range(row, 5):
+                column_sums = np.add.reduceat(a_columns[row] * a_columns[column], edge_starts)
+                a_multiplied[:, row, column] = column_sums
+                a_multiplied[:, column, row] = column_sums
+            aTb_multiplied[:, row, 0] = np.add.reduceat(a_columns[row] * b_column, edge_starts)
+
+        #np.linalg.inv raises on an exact zero pivot, which is exactly when the LU determinant is zero
+        determinant = np.linalg.det(a_multiplied)
+        valid = np.isfinite(determinant) & (determinant != 0)
+        a_multiplied[~valid] = np.eye(5)
+        result = np.matmul(np.linalg.inv(a_multiplied), aTb_multiplied)[:, :, 0]
+        return result, valid
+
+    def _calculate_center_coor_approx(self, result):
+        r0, r1, r2, r3 = result[:, 0], result[:, 1], result[:, 2], result[:, 3]
+        divisor = r0 - r1*r1
+        safe_divisor = np.where(divisor != 0, divisor, 1)
+        x_approx = np.where(divisor != 0, (r2 - r3*r1) / safe_divisor, 9999)
+        y_approx = np.where(divisor != 0, (r0*r3 - r2*r1) / safe_divisor, 9999)
+        return np.stack((x_approx, y_approx), axis=1)
+
+    def _calculate_ellipse_rotation(self, result):
+        r0, r1 = result[:, 0], result[:, 1]
+        divisor = r0 - 1
+        hypotenuse = np.where(divisor != 0, 2*r1 / np.where(divisor != 0, divisor, 1), 9999)
+        return np.degrees(0.5*np.arctan(hypotenuse))
+
+    def _calculate_axis_numerator(self, result, center):
+        return 2*(result[:, 4] + center[:, 1]*center[:, 1] + center[:, 0]*center[:, 0]*result[:, 0] + 2*result[:, 1])
+
+    def _calculate_axis_root(self, result):
+        return np.sqrt((1 - result[:, 0])**2 + 4*result[:, 1]**2)
+
+    def _calculate_ellipse_width(self, result, center):
+        width_first = self._calculate_axis_numerator(result, center)
+        width_second = (1 + result[:, 0]) - self._calculate_axis_root(result)
+        width_full = np.where(width_second != 0, width_first / np.where(width_second != 0, width_second, 1), 9999)
+        return np.sqrt(np.abs(width_full))
+
+    def _calculate_ellipse_height(self, result, center):
+        height_first = self._calculate_axis_numerator(result, center)
+        height_second = (1 + result[:, 0]) + self._calculate_axis_root(result)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            height_full = height_first / height_second
+        return np.sqrt(np.abs(height_full))
 
 
 
@@ -243,11 +698,12 @@ class EllipseFiltering:
         self.rules = rules.get_rules()
 
     def filter(self, ellipses):
+        ellipse_index = EllipseSpatialIndex(ellipses)                           #Built once per frame and handed to the rules instead of the plain list
         special_ellipses = []
         for ellipse in ellipses:
             true_list = []
             for rule in self.rules:
-                if rule(ellipses,ellipse) == False: break
+                if rule(ellipse_index, ellipse) == False: break
                 else: true_list.append(True)
             if len(true_list) == len(self.rules):
                 special_ellipses.append(ellipse)
@@ -265,11 +721,20 @@ class EllipseRules:
 
 
 class RobotEllipseRules(EllipseRules):
-    def __init__(self, visualization_level = 0):
-        self.visualization_level = 0
+    _cos_table = np.cos(np.radians(np.arange(360)))                            #Per degree, used by the not_rectangle area integration
+    _sin_table = np.sin(np.radians(np.arange(360)))
+
+    def __init__(self, visualization_level = 0, rectangle_check = False, rectangle_fill = 0.88):
+        self.visualization_level = visualization_level
+        self.rectangle_check = rectangle_check
+        self._rectangle_fill = rectangle_fill                                   #Share of its bounding rectangle a form must fill to be area tested
+        self._edge_linking = EdgeLinking()
 
     def get_rules(self):
-        return [self.super_sub_circle_rule, ]     #self.not_rectangle, self.differential_rule   self.quadrant_rule,
+        rules = [self.super_sub_circle_rule, ]     #self.differential_rule   self.quadrant_rule,
+        if self.rectangle_check == True:
+            rules.append(self.not_rectangle)
+        return rules
 
     def quadrant_rule(self, ellipses, ellipse):
         quadrant_chect_list = [0, 0, 0, 0]
@@ -284,37 +749,52 @@ class RobotEllipseRules(EllipseRules):
                 quadrant_chect_list[3] = 1
         return 0 not in quadrant_chect_list
 
-    def super_sub_circle_rule(self, ellipses, primary_ellipse):
-        new_method_result = self._outside_in_corner_points(ellipses, primary_ellipse)
+    def super_sub_circle_rule(self, ellipse_index, primary_ellipse):
+        new_method_result = self._outside_in_corner_points(ellipse_index, primary_ellipse)
         return new_method_result
 
-    def _outside_in_corner_points(self, ellipses, primary_ellipse):
-        for secondary_ellipse in ellipses:
+    def _outside_in_corner_points(self, ellipse_index, primary_ellipse):
+        for secondary_ellipse in ellipse_index.candidates(primary_ellipse):
             if  EllipseHelpFunction.is_ellipse_inside_ellipse(secondary_ellipse, primary_ellipse) == True or \
                 EllipseHelpFunction.is_ellipse_inside_ellipse(primary_ellipse, secondary_ellipse) == True:
                 return True
         return False
 
     def not_rectangle(self, ellipses, ellipse):
-        return True
         edge_pixels = ellipse.edge_pixels()
+        if len(edge_pixels) < 3:                                                #Released edge pixels (edge_retention 'none'), nothing to tell the form by
+            return True
+        hull = cv2.convexHull(np.asarray(edge_pixels, dtype=np.float32).reshape(-1, 2))
+        center, width, height, rotation_RAD = self._bounding_rectangle(hull)
+        if min(width, height) < 3:                                              #A few pixels across show no corners
+            return True
+        if cv2.contourArea(hull) < self._rectangle_fill * width * height * 4:   #Cheap first test: an ellipse fills pi/4 of its bounding rectangle, a
+            return True                                                         #rectangle all of it. Only the forms that pass are linked below
         ordered_edge_pixels = self._convert_to_connected_edge(edge_pixels)
-        area_real = self._calculate_area_of_form(ellipse.center(), ordered_edge_pixels)
-        center_angle, missing_angle = self._find_missing_angle_in_form(ellipse, ordered_edge_pixels)
-        #Calculating the ideal areas for an rectangle and ellipse with the given dimensions
-        full_rectangle_area = ellipse.height() * ellipse.width() * 4
-        area_rectangle = self._area_of_form_minus_missing_section(ellipse.width(), ellipse.height(), missing_angle, center_angle, full_rectangle_area, self._calculate_vector_to_edge_from_angle_rectangle)
-        full_ellipse_area = ellipse.height() * ellipse.width() * math.pi
-        area_ellipse = self._area_of_form_minus_missing_section(ellipse.width(), ellipse.height(), missing_angle, center_angle, full_ellipse_area, self._calculate_vector_to_edge_from_angle_ellipse)
+        area_real = self._calculate_area_of_form(center, ordered_edge_pixels)
+        center_angle, missing_angle = self._find_missing_angle_in_form(center, rotation_RAD, ordered_edge_pixels)
+        #Calculating the ideal areas for an rectangle and ellipse that fill the same bounding rectangle
+        full_rectangle_area = height * width * 4
+        area_rectangle = self._area_of_form_minus_missing_section(width, height, missing_angle, center_angle, full_rectangle_area, self._calculate_vectors_to_edge_rectangle)
+        full_ellipse_area = height * width * math.pi
+        area_ellipse = self._area_of_form_minus_missing_section(width, height, missing_angle, center_angle, full_ellipse_area, self._calculate_vectors_to_edge_ellipse)
         #Determine if the form is closest to an ellipse based area
         ellipse_area_diff = abs(area_real - area_ellipse)
         rectangle_area_diff = abs(area_real - area_rectangle)
         return ellipse_area_diff < rectangle_area_diff
 
 
-    def _find_missing_angle_in_form(self, ellipse, ordered_edge_pixels):
-        center_pixel = ellipse.center()
-        shift_rotation_RAD = ellipse.rotation('rad')
+    def _bounding_rectangle(self, points):
+        #Smallest rotated rectangle around the points (e.g. the convex hull of an edge) as (center, half width, half height,
+        #rotation), in the (row, column) frame of the pixels. The ellipse fitted to a rectangle's edge is bigger than the
+        #rectangle, so the fitted axes would make every form look like an ellipse
+        corners = cv2.boxPoints(cv2.minAreaRect(points))
+        width_side = corners[1] - corners[0]
+        height_side = corners[2] - corners[1]
+        rotation_RAD = math.atan2(width_side[1], width_side[0]) % math.radians(360)
+        return tuple(corners.mean(axis=0)), math.hypot(*width_side) / 2, math.hypot(*height_side) / 2, rotation_RAD
+
+    def _find_missing_angle_in_form(self, center_pixel, shift_rotation_RAD, ordered_edge_pixels):
         first_pixel = ordered_edge_pixels[0]
         middle_pixel = ordered_edge_pixels[int(len(ordered_edge_pixels)/2)]
         last_pixel = ordered_edge_pixels[-1]
@@ -341,19 +821,14 @@ class RobotEllipseRules(EllipseRules):
         return center_angle_relative_RAD, missing_angle_span_RAD
 
     def _vector_angle(self, vector):
-        x = vector[0]
-        y = vector[1]
-        angle = abs(math.atan(y/x))
-        if x < 0: angle += math.radians(90)
-        if y < 0: angle += math.radians(180)
-        return angle
+        return math.atan2(vector[1], vector[0]) % math.radians(360)
 
     def _make_angle_relative(self, angle_RAD, rotation_RAD):
         relative_angle = angle_RAD - rotation_RAD
         if relative_angle < math.radians(0): 
             relative_angle = math.radians(360) + relative_angle
         elif relative_angle > math.radians(360):
-            relative_angle = relative_angle - 360
+            relative_angle = relative_angle - math.radians(360)
         return relative_angle
 
 
@@ -364,187 +839,134 @@ class RobotEllipseRules(EllipseRules):
         return math.sqrt(self._dotproduct_of_two_vectors(v, v))
 
     def _angle_between_two_vectors(self, v1, v2):
-        return math.acos(self._dotproduct_of_two_vectors(v1, v2) / (self._length_of_vector(v1) * self._length_of_vector(v2)))
-
-    def _calculate_section_area_from_integral_vectors(self, integral_vectors):
-        section_area = 0
-        for point_nr, edge_point in enumerate(integral_vectors):
-            if point_nr > 0:
-                first_vector = integral_vectors[point_nr-1]
-                second_vector = integral_vectors[point_nr]
-                triangle_area = self._calculate_triangle_area_vectors(first_vector, second_vector)
-                section_area += triangle_area
-        return section_area
-
+        lengths = self._length_of_vector(v1) * self._length_of_vector(v2)
+        if lengths == 0:
+            return 0
+        return math.acos(max(-1, min(1, self._dotproduct_of_two_vectors(v1, v2) / lengths)))   #Rounding can leave the cosine just outside [-1, 1]
 
     def _area_of_form_minus_missing_section(self,  width, height, missing_RAD, center_angle_RAD, full_area, vector_function):
         first_RAD = center_angle_RAD - (missing_RAD / 2)
         last_RAD = center_angle_RAD + (missing_RAD / 2)
 
-        #Find edge vectors based on section integrale
-        integral_vectors = []
+        #Find edge vectors based on section integrale (one per degree, from the cached trig tables)
         starting_angle = math.floor(math.degrees(first_RAD))
         ending_angle = math.ceil(math.degrees(last_RAD))
-        for angle in range(starting_angle, ending_angle+1, 1):
-            edge_point_at_angle = vector_function(width, height, math.radians(angle))
-            integral_vectors.append(edge_point_at_angle)
+        angles = np.arange(starting_angle, ending_angle+1) % 360
+        vectors_x, vectors_y = vector_function(width, height, self._cos_table[angles], self._sin_table[angles])
 
-        #Find section area based on edge vectors
-        section_area = self._calculate_section_area_from_integral_vectors(integral_vectors)
+        #Find section area based on edge vectors: the triangles between the center and each pair of neighbouring vectors
+        section_area = np.sum(np.abs(vectors_x[:-1] * vectors_y[1:] - vectors_y[:-1] * vectors_x[1:])) / 2
 
         #substract extra area from full area
-        section_triangle_area = self._calculate_triangle_area_vectors(integral_vectors[0], integral_vectors[-1])
+        section_triangle_area = abs(vectors_x[0] * vectors_y[-1] - vectors_y[0] * vectors_x[-1]) / 2
         substraction_area = section_area - section_triangle_area
         area = full_area - substraction_area
         return area
 
 
-    def _calculate_vector_to_edge_from_angle_rectangle(self, width, height, angle):
-        width_half = width
-        height_half = height
+    def _calculate_vectors_to_edge_rectangle(self, width, height, cos_angles, sin_angles):
+        #Where the rays hit a rectangle with the half sides width and height
+        with np.errstate(divide='ignore'):
+            length_to_side = np.minimum(width / np.abs(cos_angles), height / np.abs(sin_angles))
+        return cos_angles * length_to_side, sin_angles * length_to_side
+
+    def _calculate_vectors_to_edge_ellipse(self, width, height, cos_angles, sin_angles):
+        radius_at_angles = (width * height) / np.sqrt(((height**2)*(sin_angles**2)) + ((width**2)*(cos_angles**2)))
+        return cos_angles * radius_at_angles, sin_angles * radius_at_angles
+
+
+    def _calculate_area_of_form(self, center, ordered_edge_pixels):
+        #Shoelace formula over the closed line of edge pixels, relative to the center
+        vectors = np.asarray(ordered_edge_pixels, dtype=np.float64) - np.asarray(center, dtype=np.float64)
+        vectors_x = vectors[:, 0]
+        vectors_y = vectors[:, 1]
+        full_area = abs(np.sum(vectors_x * np.roll(vectors_y, -1) - vectors_y * np.roll(vectors_x, -1))) / 2
+        return full_area
+
+
+    def _convert_to_connected_edge(self, edge_pixels):
+        return self._edge_linking.connect(edge_pixels)
+
+
+
+
+
 
-        corner_angle_1 = math.atan(height_half / width_half)
-        corner_angle_2 = math.atan(height_half / -width_half)
-        corner_angle_3 = math.atan(-height_half / -width_half)
-        corner_angle_4 = math.atan(-height_half / width_half)
 
-        if (angle > corner_angle_1 and angle < corner_angle_2) or (angle > corner_angle_3 and angle < corner_angle_4):
-            #Use height
-            angle = 90-angle
-            x = math.sin(angle) * (height_half / math.cos(angle))
-            y = math.cos(angle) * (height_half / math.cos(angle))
-        else:
-            #Use width
-            x = math.cos(angle) * (width_half / math.cos(angle))
-            y = math.sin(angle) * (width_half / math.cos(angle))
 
-        return (x, y)
 
-    def _calculate_vector_to_edge_from_angle_ellipse(self, width, height, angle):
-        radius_at_angle = self._calculate_ellipse_radius_at_angle(width, height, angle)
-        width = math.cos(angle) * radius_at_angle
-        height = math.sin(angle) * radius_at_angle
-        return (width, height)
 
-    def _calculate_ellipse_radius_at_angle(self, width, height, angle):
-        return (width * height) / math.sqrt(((height**2)*(math.sin(angle)**2)) + ((width**2)*(math.cos(angle)**2)))
 
 
-    def _calculate_area_of_form(self, center, ordered_edge_pixels):
-        full_area = 0
-        current_pixel = None
-        last_pixel = ordered_edge_pixels[0]
-        for pixel in ordered_edge_pixels[1:]:
-            current_pixel = pixel
-            triangle_area = self._calculate_triangle_area_three_point(center, current_pixel, last_pixel)
-            full_area += triangle_area
-            last_pixel = current_pixel
-        current_pixel = ordered_edge_pixels[0]
-        triangle_area = self._calculate_triangle_area_three_point(center, current_pixel, last_pixel)
-        full_area += triangle_area
-        return full_area
 
 
-    def _calculate_triangle_area_three_point(self, point_a, point_b, point_c):
-        #Get two vectors from points
-        vector_a = (abs(point_a[0] - point_b[0]), abs(point_a[1] - point_b[1]))
-        vector_b = (abs(point_a[0] - point_c[0]), abs(point_a[1] - point_c[1]))
-        vector_a_np = np.asarray(vector_a)
-        vector_b_np = np.asarray(vector_b)
-        triangle_area = self._calculate_triangle_area_vectors(vector_a_np, vector_b_np)
-        return triangle_area
-
-    def _calculate_triangle_area_vectors(self, vec_a, vec_b):
-        #Calculate rectangle area with cross-product
-        cross_product = np.cross(vec_a, vec_b)
-        full_area = np.linalg.norm(cross_product)
-        #Half of area gives an triangle
-        triangle_area = full_area / 2
-        return triangle_area
-
-
-    def _length_between_points(self, point_a, point_b):
-        x_diff = abs(point_a[0] - point_b[0])
-        y_diff = abs(point_a[1] - point_b[1])
-        length = x_diff if x_diff > y_diff else y_diff
-        return length
-
-
-    def _find_list_to_connect(self, list_of_lists, sub_list, index_nr = -1):
-        index = -1
-        flags = { 'reverse': 0, 'order': 1 }
-        for index_count, list in enumerate(list_of_lists):
-            if index_count != index_nr:
-                first_px_of_list = list[0]
-                last_px_of_list = list[-1]
-                first_px_of_sub = sub_list[0]
-                last_px_of_sub = sub_list[-1]
-
-                if self._length_between_points(first_px_of_list, first_px_of_sub) == 1:
-                    flags['reverse'] = 1
-                    flags['order'] = 1
-                    index = index_count
-                    break
-                elif self._length_between_points(first_px_of_list, last_px_of_sub) == 1:
-                    flags['reverse'] = 0
-                    flags['order'] = 2
-                    index = index_count
-                    break
-                elif self._length_between_points(last_px_of_list, first_px_of_sub) == 1:
-                    flags['reverse'] = 0
-                    flags['order'] = 1
-                    index = index_count
-                    break
-                elif self._length_between_points(last_px_of_list, last_px_of_sub) == 1:
-                    flags['reverse'] = 2
-                    flags['order'] = 1
-                    index = index_count
-                    break
 
-        return index, flags
+class EdgeLinking:
+    #Orders the pixels of an edge into one connected line. The pixels are cut into runs of 8-connected neighbours, the
+    #run endpoints are put in a hash map keyed by pixel, and the line is grown from the first run by looking up the 8
+    #neighbours of its current ends. Every lookup is constant time, so linking is linear in the number of pixels
+    _neighbour_offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
 
-    def _convert_to_connected_edge(self, ordered_edge):
-        ordered_edge_list = ordered_edge
-        ordered_edge_list.append((999999, 999999))
+    def connect(self, edge_pixels):
+        runs = self._split_into_runs(edge_pixels)
+        if len(runs) == 0:
+            return []
+        endpoint_map = self._build_endpoint_map(runs)
+        used_runs = {0}
+        line = list(runs[0])
+        self._grow_line(line, runs, endpoint_map, used_runs)
+        line.reverse()
+        self._grow_line(line, runs, endpoint_map, used_runs)
+        line.reverse()
+        return line
 
-        list_of_lists = [[ordered_edge_list[0]]]
-        sub_list = [ordered_edge_list[1]]                        #Sub connected graph / link / connections
+    def _split_into_runs(self, edge_pixels):
+        pixels = np.asarray(edge_pixels, dtype=np.int64).reshape(-1, 2)
+        if len(pixels) == 0:
+            return []
+        steps = np.abs(np.diff(pixels, axis=0)).max(axis=1)
+        keep = np.concatenate(([True], steps != 0))                             #Repeated pixels add nothing to the line
+        pixels = pixels[keep]
+        steps = steps[steps != 0]
+        run_bounds = np.concatenate(([0], np.flatnonzero(steps > 1) + 1, [len(pixels)])).tolist()
+        pixel_list = [tuple(pixel) for pixel in pixels.tolist()]
+        return [pixel_list[run_bounds[index]:run_bounds[index + 1]] for index in range(len(run_bounds) - 1)]
 
-        for pixel in ordered_edge_list[1:]:
-            length = self._length_between_points(pixel, sub_list[-1])
-            if length == 1:
-                sub_list.append(pixel)
-            if length > 1:
-                index, end_flags = self._find_list_to_connect(list_of_lists, sub_list)
-                if index == -1: list_of_lists.append(sub_list)
-                else:
-                    if end_flags['reverse'] == 1:
-                        list_of_lists[index].reverse()
-                    elif end_flags['reverse'] == 2:
-                        sub_list.reverse()
-                    if end_flags['order'] == 1:
-                        list_of_lists[index].extend(sub_list)
-                    elif end_flags['order'] == 2:
-                        sub_list.extend(list_of_lists[index])
-                        list_of_lists[index] = sub_list
+    def _build_endpoint_map(self, runs):
+        endpoint_map = {}
+        for run_index, run in enumerate(runs):
+            endpoint_map.setdefault(run[0], []).append((run_index, True))
+            if len(run) > 1:
+                endpoint_map.setdefault(run[-1], []).append((run_index, False))
+        return endpoint_map
 
-                    old_index = index
-                    new_index, end_flags = self._find_list_to_connect(list_of_lists, list_of_lists[old_index], old_index)
-                    if new_index != -1:
-                        if end_flags['reverse'] == 1:
-                            list_of_lists[new_index].reverse()
-                        elif end_flags['reverse'] == 2:
-                            list_of_lists[old_index].reverse()
-                        if end_flags['order'] == 1:
-                            list_of_lists[new_index].extend(list_of_lists[old_index])
-                            del list_of_lists[old_index]
-                        elif end_flags['order'] == 2:
-                            list_of_lists[old_index].extend(list_of_lists[new_index])
-                            del list_of_lists[new_index]
-                sub_list = [pixel]
+    def _grow_line(self, line, runs, endpoint_map, used_runs):
+        while True:
+            next_run = self._find_run_at_end(line[-1], endpoint_map, used_runs, runs)
+            if next_run is None:
+                return
+            run_index, at_start = next_run
+            used_runs.add(run_index)
+            line.extend(runs[run_index] if at_start else reversed(runs[run_index]))
 
-        return list_of_lists[0]
+    def _find_run_at_end(self, end_pixel, endpoint_map, used_runs, runs):
+        #A run that can be continued after it is preferred: short runs often touch the line end with both of their
+        #ends, and entering at the wrong one would end the line there
+        first_candidate = None
+        for run_index, at_start in self._unused_runs_at(end_pixel, endpoint_map, used_runs):
+            if first_candidate is None:
+                first_candidate = (run_index, at_start)
+            new_end_pixel = runs[run_index][-1] if at_start else runs[run_index][0]
+            for next_run_index, _ in self._unused_runs_at(new_end_pixel, endpoint_map, used_runs):
+                if next_run_index != run_index:
+                    return run_index, at_start
+        return first_candidate
 
+    def _unused_runs_at(self, end_pixel, endpoint_map, used_runs):
+        for offset in self._neighbour_offsets:
+            for run_index, at_start in endpoint_map.get((end_pixel[0] + offset[0], end_pixel[1] + offset[1]), ()):
+                if run_index not in used_runs:
+                    yield run_index, at_start
 
 
 
@@ -552,6 +974,127 @@ class RobotEllipseRules(EllipseRules):
 
 
 
+class EllipseSpatialIndex:
+    #Uniform grid over the ellipse centers. Every ellipse is stored in all cells its bounding circle (center, max_size)
+    #touches, so the pairs EllipseHelpFunction.is_ellipse_inside_ellipse can accept - centers closer than the larger of
+    #the two max sizes - are found by looking only at the cells around one ellipse
+    def __init__(self, ellipses, cell_size = None):
+        self._ellipses = list(ellipses)
+        self._centers = np.array([ellipse.center() for ellipse in self._ellipses], dtype=np.float64).reshape(-1, 2)
+        self._radii = np.array([ellipse.max_size() for ellipse in self._ellipses], dtype=np.float64)
+        self._cell_size = cell_size if cell_size is not None else self._estimate_cell_size(self._radii)
+        self._grid = {}
+        for index in range(len(self._ellipses)):
+            for cell in self._cells_in_circle(self._centers[index], self._radii[index]):
+                self._grid.setdefault(cell, []).append(index)
+
+    def __len__(self):
+        return len(self._ellipses)
+
+    def __iter__(self):
+        return iter(self._ellipses)
+
+    def __getitem__(self, index):
+        return self._ellipses[index]
+
+    def _estimate_cell_size(self, radii):
+        if len(radii) == 0:
+            return 1.0
+        return max(float(np.median(radii)) * 2, 1.0)
+
+    def _cells_in_circle(self, center, radius):
+        first_x = int(math.floor((center[0] - radius) / self._cell_size))
+        last_x = int(math.floor((center[0] + radius) / self._cell_size))
+        first_y = int(math.floor((center[1] - radius) / self._cell_size))
+        last_y = int(math.floor((center[1] + radius) / self._cell_size))
+        return [(cell_x, cell_y) for cell_x in range(first_x, last_x + 1) for cell_y in range(first_y, last_y + 1)]
+
+    def candidate_indices(self, ellipse):
+        #Indices (in insertion order) of the ellipses that can contain, or be contained by, the ellipse
+        center = np.asarray(ellipse.center(), dtype=np.float64)
+        radius = ellipse.max_size()
+        cell_indices = set()
+        for cell in self._cells_in_circle(center, radius):
+            cell_indices.update(self._grid.get(cell, ()))
+        if len(cell_indices) == 0:
+            return []
+        indices = np.fromiter(sorted(cell_indices), dtype=np.int64, count=len(cell_indices))
+        distances = np.hypot(self._centers[indices, 0] - center[0], self._centers[indices, 1] - center[1])
+        in_range = (distances < radius) | (distances < self._radii[indices])
+        return [index for index in indices[in_range].tolist() if self._ellipses[index] != ellipse]
+
+    def candidates(self, ellipse):
+        return [self._ellipses[index] for index in self.candidate_indices(ellipse)]
+
+    def indices_within(self, center, radius):
+        #Indices (in insertion order) of the ellipses whose bounding circle overlaps the circle (center, radius)
+        center = np.asarray(center, dtype=np.float64)
+        cell_indices = set()
+        for cell in self._cells_in_circle(center, radius):
+            cell_indices.update(self._grid.get(cell, ()))
+        if len(cell_indices) == 0:
+            return []
+        indices = np.fromiter(sorted(cell_indices), dtype=np.int64, count=len(cell_indices))
+        distances = np.hypot(self._centers[indices, 0] - center[0], self._centers[indices, 1] - center[1])
+        return indices[distances < radius + self._radii[indices]].tolist()
+
+
+
+
+
+
+
+class EllipseHierarchy:
+    #Containment tree over the ellipses of one frame, like a contour hierarchy: each ellipse gets the smallest ellipse
+    #containing it as parent. A parent always has a larger area (ties go to the lower index), so the result is a tree
+    def __init__(self, ellipses, ellipse_index = None):
+        self._ellipse_index = ellipse_index if ellipse_index is not None else EllipseSpatialIndex(ellipses)
+        self._ellipses = list(self._ellipse_index)
+        self._areas = [ellipse.width() * ellipse.height() for ellipse in self._ellipses]
+        self._parents = [self._find_parent(index) for index in range(len(self._ellipses))]
+        self._children = [[] for _ in self._ellipses]
+        for index, parent in enumerate(self._parents):
+            if parent != -1:
+                self._children[parent].append(index)
+
+    def __len__(self):
+        return len(self._ellipses)
+
+    def __getitem__(self, index):
+        return self._ellipses[index]
+
+    def _find_parent(self, index):
+        ellipse = self._ellipses[index]
+        parent = -1
+        for candidate in self._ellipse_index.candidate_indices(ellipse):
+            if not self._is_larger(candidate, index):
+                continue
+            if parent != -1 and not self._is_larger(parent, candidate):
+                continue
+            if EllipseHelpFunction.is_ellipse_inside_ellipse(ellipse, self._ellipses[candidate]):
+                parent = candidate
+        return parent
+
+    def _is_larger(self, index_a, index_b):
+        return self._areas[index_a] > self._areas[index_b] or (self._areas[index_a] == self._areas[index_b] and index_a < index_b)
+
+    def parent(self, index):
+        return self._parents[index]
+
+    def children(self, index):
+        return self._children[index]
+
+    def descendants(self, index):
+        descendants = []
+        stack = list(self._children[index])
+        while len(stack) > 0:
+            child = stack.pop()
+            descendants.append(child)
+            stack.extend(self._children[child])
+        return sorted(descendants)
+
+    def roots(self):
+        return [index for index, parent in enumerate(self._parents) if parent == -1]
 
 
 
@@ -0,0 +1,150 @@
+import logging
+import threading
+import collections
+import time
+import sys
+import numpy as np
+
+
+
+class EventLog:
+    #Messages go through the standard logging module (configure handlers there, e.g. logging.basicConfig). Arguments are
+    #only formatted when a message is emitted, so a disabled level costs a comparison
+    def __init__(self, name = 'robot_tracking', level = logging.INFO, rate_limit = 1.0, pose_buffer_size = 0):
+        self._logger = logging.getLogger(name)
+        self._level = level
+        self._rate_limit = rate_limit                                           #Seconds between two messages with the same key, 0: no limit
+        self._last_emitted = {}                                                 #key -> [time of the last message, messages suppressed since]
+        self._pose_records = collections.deque(maxlen = pose_buffer_size) if pose_buffer_size > 0 else None
+        self._pose_count = 0                                                    #Poses recorded so far, see export_records
+        self._forwarded = None                                                  #See forward_messages
+        self._message_count = 0
+        self._imported = {}                                                     #source -> (message count, pose count) of the last import_records
+        self._lock = threading.Lock()
+
+    def __getstate__(self):                                                     #A copy (e.g. in a camera worker process) keeps the settings and starts empty
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_last_emitted'] = {}
+        state['_pose_records'] = collections.deque(maxlen = self._pose_records.maxlen) if self._pose_records != None else None
+        state['_pose_count'] = 0
+        state['_forwarded'] = None
+        state['_message_count'] = 0
+        state['_imported'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def set_level(self, level):
+        self._level = level
+
+    def is_enabled(self, level):
+        return level >= self._level and self._logger.isEnabledFor(level)
+
+    def debug(self, key, message, *args):
+        self.log(logging.DEBUG, key, message, *args)
+
+    def info(self, key, message, *args):
+        self.log(logging.INFO, key, message, *args)
+
+    def warning(self, key, message, *args):
+        self.log(logging.WARNING, key, message, *args)
+
+    def error(self, key, message, *args):
+        self.log(logging.ERROR, key, message, *args)
+
+    def log(self, level, key, message, *args):
+        #message is a %-format string. key groups messages for the rate limit, None: never limited
+        if not self.is_enabled(level):
+            return
+        suppressed = self._pass_rate_limit(key)
+        if suppressed == None:
+            return
+        if suppressed > 0:
+            message = message + " (%d similar messages suppressed)"
+            args = args + (suppressed,)
+        if self._forwarded != None:
+            with self._lock:
+                self._forwarded.append((level, message % args if len(args) > 0 else message))
+                self._message_count += 1
+            return
+        self._logger.log(level, message, *args)
+
+    def _pass_rate_limit(self, key):
+        #None if the message is suppressed, else the number of messages with key suppressed since the last one
+        if key == None or self._rate_limit <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_emitted.get(key)
+            if last != None and now - last[0] < self._rate_limit:
+                last[1] += 1
+                return None
+            self._last_emitted[key] = [now, 0]
+            return last[1] if last != None else 0
+
+    def record_pose(self, cam_name, marker_id, rvec, tvec, distance, angle):
+        #Kept as given in a ring buffer of the last pose_buffer_size poses, nothing is formatted until dumped
+        if self._pose_records == None:
+            return
+        with self._lock:
+            self._pose_records.append((time.time(), cam_name, marker_id, rvec, tvec, distance, angle))
+            self._pose_count += 1
+
+    def get_pose_records(self):
+        records = list(self._pose_records) if self._pose_records != None else []
+        return [{ 'time': record[0], 'cam': record[1], 'id': record[2], 'rvec': record[3], 'tvec': record[4], 'distance': record[5], 'angle': record[6] } for record in records]
+
+    def dump_pose_records(self, file = None):
+        file = file if file != None else sys.stdout
+        records = self.get_pose_records()
+        for record in records:
+            file.write("%.3f %s (%s) rvec: %s tvec: %s distance: %s angle: %s\n" % (record['time'], record['cam'], record['id'], np.ravel(record['rvec']).tolist(),
+                                                                               np.ravel(record['tvec']).tolist(), record['distance'], record['angle']))
+        return len(records)
+
+    def clear_pose_records(self):
+        if self._pose_records != None:
+            self._pose_records.clear()
+
+    def forward_messages(self, buffer_size = 100):
+        #Keeps the last buffer_size emitted messages (formatted) for export_records instead of logging them, for a copy in a
+        #process without logging set up
+        self._forwarded = collections.deque(maxlen = buffer_size)
+
+    def export_records(self):
+        #{ 'messages': (count, latest (level, text)), 'poses': (count, latest pose records) } for import_records of the EventLog
+        #in another process
+        with self._lock:
+            return { 'messages': (self._message_count, list(self._forwarded) if self._forwarded != None else []),
+                     'poses': (self._pose_count, list(self._pose_records) if self._pose_records != None else []) }
+
+    def import_records(self, source, exported):
+        #Logs the messages and keeps the poses the exporting copy recorded since the last import from source (e.g. a camera
+        #name), importing the same export twice changes nothing
+        message_count, messages = exported['messages']
+        pose_count, poses = exported['poses']
+        with self._lock:
+            last_message_count, last_pose_count = self._imported.get(source, (0, 0))
+            self._imported[source] = (max(message_count, last_message_count), max(pose_count, last_pose_count))
+            if self._pose_records != None:
+                self._pose_records.extend(poses[max(len(poses) - (pose_count - last_pose_count), 0):])
+                self._pose_count += max(pose_count - last_pose_count, 0)
+        for level, text in messages[max(len(messages) - (message_count - last_message_count), 0):]:
+            if self.is_enabled(level):
+                self._logger.log(level, "%s", text)
+
+
+
+
+
+
+
+
+
+
+
+
+#Nothing
@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+import threading
+
+
+
+_thread_clahe = threading.local()
+
+def create_clahe():
+    return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+
+def thread_clahe():
+    #One CLAHE per thread, for contexts made without a camera
+    if getattr(_thread_clahe, 'instance', None) == None:
+        _thread_clahe.instance = create_clahe()
+    return _thread_clahe.instance
+
+def frame_context(frame, clahe = None):
+    if isinstance(frame, FrameContext):                                         #Already wrapped, keep its cache
+        return frame
+    return FrameContext(frame, clahe)
+
+
+
+
+
+
+
+class FrameContext:
+    #clahe is a CLAHE object or a function returning one. CLAHE objects must not be shared between threads, a function
+    #like CameraBase.get_clahe gives every thread its own
+    def __init__(self, frame, clahe = None, offset = (0, 0), parent = None, region = None):
+        self._frame = frame
+        self._clahe = clahe
+        self._offset = offset                                                   #(x, y) of the frame in the full frame
+        self._parent = parent
+        self._region = region                                                   #(x0, y0, x1, y1) in the parent frame
+        self._cache = {}
+
+    def frame(self):
+        return self._frame
+
+    def shape(self):
+        return self._frame.shape
+
+    def offset(self):
+        return self._offset
+
+    def gray(self):
+        if 'gray' not in self._cache:
+            self._cache['gray'] = self._calculate_gray()
+        return self._cache['gray']
+
+    def _calculate_gray(self):
+        if self._parent != None and 'gray' in self._parent._cache:              #Gray is per pixel, a crop of the parent's gray is the same
+            x0, y0, x1, y1 = self._region
+            return self._parent._cache['gray'][y0:y1, x0:x1]
+        if len(self._frame.shape) == 2:
+            return self._frame
+        return cv2.cvtColor(self._frame, cv2.COLOR_BGR2GRAY)
+
+    def inverted(self):
+        if 'inverted' not in self._cache:
+            self._cache['inverted'] = cv2.bitwise_not(self.gray())
+        return self._cache['inverted']
+
+    def clahe(self):
+        if 'clahe' not in self._cache:
+            self._cache['clahe'] = self._get_clahe().apply(self.gray())
+        return self._cache['clahe']
+
+    def _get_clahe(self):
+        if self._clahe == None:
+            self._clahe = thread_clahe
+        if callable(self._clahe):                                               #e.g. CameraBase.get_clahe, asked in the thread that applies it
+            return self._clahe()
+        return self._clahe
+
+    def pyramid(self, depth, image = 'clahe'):
+        key = 'pyramid_' + image
+        if key not in self._cache:
+            self._cache[key] = [self._get_image(image)]
+        levels = self._cache[key]
+        while len(levels) < depth:                                              #Levels are added on demand and kept for deeper requests
+            levels.append(cv2.pyrDown(levels[-1]))
+        return levels[:depth]
+
+    def _get_image(self, image):
+        if image == 'frame': return self.frame()
+        elif image == 'gray': return self.gray()
+        elif image == 'inverted': return self.inverted()
+        elif image == 'clahe': return self.clahe()
+        else: raise Exception("Unknown image type: " + str(image))
+
+    def sub_context(self, starting_point, ending_point):
+        x0, y0 = starting_point
+        x1, y1 = ending_point
+        sub_frame = self._frame[y0:y1, x0:x1]
+        offset = (self._offset[0] + x0, self._offset[1] + y0)
+        if self._clahe == None:                                                 #Sub contexts can go to other threads, each asks for its own CLAHE
+            self._clahe = thread_clahe
+        return FrameContext(sub_frame, self._clahe, offset, self, (x0, y0, x1, y1))
+
+
+
+
+
+
+
+
+
+
+
+
+
+#Nothing
@@ -3,30 +3,94 @@ import cv2, PIL
 from cv2 import aruco
 import pandas as pd
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from Models.EllipseModels import Ellipse, RobotEllipse
 from Models.SquareModels import RobotSquare
 from SpecialEllipses import SpecialEllipses
+from FramePreprocessing import frame_context
 
 
 #-----------------------
 
 class MarkerDetection:
-    def __init__(self, marker_type = aruco.DICT_6X6_250):
+    def __init__(self, marker_type = aruco.DICT_6X6_250, full_detection_interval = None, marker_ids = None, full_search_interval = None, search_padding = 1.0,
+                 ellipse_workers = None, max_queued_markers = None, pose_warm_start = False, max_reprojection_error = 0.5,
+                 pose_hold_error = None, rectangle_check = False):
         self._marker_type = marker_type
-        self._marker_dict = aruco.Dictionary_get(self._marker_type)
-        self.special_ellipses = SpecialEllipses(125)
-
-    def get_markers(self, frame):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.bitwise_not(gray)
-        parameters =  aruco.DetectorParameters_create()
-        corners, ids, rejectedImgPoints = aruco.detectMarkers(gray, self._marker_dict, parameters=parameters)
+        self._full_search_interval = full_search_interval                       #None: search the whole frame every time, K: search around known markers, the whole frame every K'th frame
+        self._search_padding = search_padding                                   #Region around a known marker, in marker sizes
+        self._marker_tracks = {}                                                #cam name -> { id: { 'center', 'size', 'motion' } }
+        self._search_status = {}
+        self._ellipse_workers = ellipse_workers                                 #None: sub frames one after the other, N: in a pool of N threads (Canny and CLAHE release the GIL)
+        self._max_queued_markers = max_queued_markers if max_queued_markers != None else 2 * (ellipse_workers or 1)
+        self._executor = None
+        self._executor_lock = threading.Lock()                                  #Thread camera workers share one MarkerDetection
+        self._pose_warm_start = pose_warm_start                                 #Solve a marker seen before from its last pose (needs marker ids in the pose calls)
+        self._max_reprojection_error = max_reprojection_error                   #RMS pixels a warm started pose may reproject worse than the pose it started from
+        self._pose_hold_error = pose_hold_error                                 #None: always refine, E: keep the cached pose while it reprojects within E pixels
+        self._pose_cache = {}                                                   #cam name -> { id: (marker size, rvec, tvec, reprojection error) }
+        self._pose_statistics = {}
+        self._marker_ids = marker_ids
+        self._marker_dict, self._marker_id_map = self._create_marker_dictionary(marker_type, marker_ids)
+        self._detector_parameters = aruco.DetectorParameters_create()          #Built once, detectMarkers does not change it
+        edge_retention = 'full' if rectangle_check else 'none'                  #Only the ellipse parameters are used from here on, the rectangle check links every edge pixel
+        self.special_ellipses = SpecialEllipses(125, edge_retention = edge_retention, full_detection_interval = full_detection_interval, rectangle_check = rectangle_check)
+
+    def __getstate__(self):                                                     #For process camera workers, the aruco objects and the pool are made again
+        state = self.__dict__.copy()
+        for name in ('_marker_dict', '_marker_id_map', '_detector_parameters'):
+            del state[name]
+        state['_executor'] = None
+        del state['_executor_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._marker_dict, self._marker_id_map = self._create_marker_dictionary(self._marker_type, self._marker_ids)
+        self._detector_parameters = aruco.DetectorParameters_create()
+        self._executor_lock = threading.Lock()
+
+    def _create_marker_dictionary(self, marker_type, marker_ids):
+        #With marker_ids only those markers are decoded: a custom dictionary holds their bits, and the index it reports is
+        #mapped back to the id in marker_type
+        marker_dict = aruco.Dictionary_get(marker_type)
+        if marker_ids == None:
+            return marker_dict, None
+        marker_ids = sorted(set(int(marker_id) for marker_id in marker_ids))
+        if len(marker_ids) == 0:
+            raise Exception("marker_ids is empty, no marker could be found. Use None to decode every marker of the dictionary")
+        outside_ids = [marker_id for marker_id in marker_ids if not 0 <= marker_id < len(marker_dict.bytesList)]
+        if len(outside_ids) > 0:
+            raise Exception("Marker ids " + str(outside_ids) + " are not in the dictionary (ids 0 to " + str(len(marker_dict.bytesList) - 1) + ")")
+        marker_id_map = np.array(marker_ids, dtype=np.int32)
+        reduced_dict = aruco.custom_dictionary(0, marker_dict.markerSize, 1)
+        reduced_dict.bytesList = marker_dict.bytesList[marker_id_map].copy()
+        reduced_dict.maxCorrectionBits = marker_dict.maxCorrectionBits           #The subset is at least as far apart, the same correction is safe
+        return reduced_dict, marker_id_map
+
+    def get_markers(self, frame, cam = None):                                   #frame can be an image or a FrameContext
+        gray = frame_context(frame).inverted()
+        if self._full_search_interval == None or cam == None:                   #Regions are tracked per camera
+            return self._detect_markers(gray)
+        return self._search_markers(gray, cam.get_name())
+
+    def get_search_status(self, cam):
+        #How the last get_markers call for cam searched: { 'mode': 'full' or 'roi', 'reason': why a full search was done,
+        #'searched_fraction': share of the frame searched } plus the number of full and roi searches so far
+        return dict(self._search_status.get(cam.get_name(), {}))
+
+    def _detect_markers(self, gray, offset = (0, 0)):
+        corners, ids, rejectedImgPoints = aruco.detectMarkers(gray, self._marker_dict, parameters=self._detector_parameters)
+        if ids is not None and self._marker_id_map is not None:
+            ids = self._marker_id_map[ids]
 
         markers = []
         if ids is not None:
             for i in range(len(ids)):
                 marker = {'id': 0, 'corners': [], 'size': 0, 'center': (0, 0)}
+                corners[i][0] += offset                                         #From the searched region to the full frame
                 c = corners[i][0]
                 marker['id'] = ids[i][0]
                 marker['corners'] = corners[i]
@@ -35,6 +99,73 @@ class MarkerDetection:
                 markers.append(marker)
         return markers
 
+    def _search_markers(self, gray, cam_name):
+        #Searches only around the markers of the previous frames (moved by their last motion and padded by their size and
+        #motion), and the whole frame every full_search_interval frames or when a tracked marker was not found
+        tracks = self._marker_tracks.get(cam_name, {})
+        status = self._search_status.setdefault(cam_name, { 'full_searches': 0, 'roi_searches': 0 })
+        frames_since_full_search = status.get('frames_since_full_search', 0)
+        reason = None
+        if len(tracks) == 0:
+            reason = 'no_markers'
+        elif frames_since_full_search + 1 >= self._full_search_interval:
+            reason = 'interval'
+        elif any(track['missed'] > 0 for track in tracks.values()):            #A marker still out of sight needs the full search anyway, the regions would only add to it
+            reason = 'missing'
+        else:
+            regions = self._get_search_regions(tracks, gray.shape)
+            markers = []
+            for first_x, first_y, last_x, last_y in regions:
+                markers.extend(self._detect_markers(gray[first_y:last_y, first_x:last_x], (first_x, first_y)))
+            markers = list({ marker['id']: marker for marker in markers }.values())   #Overlapping regions can find a marker twice
+            if set(tracks) <= set(marker['id'] for marker in markers):
+                status.update({ 'mode': 'roi', 'reason': None, 'frames_since_full_search': frames_since_full_search + 1,
+                                'searched_fraction': sum((last_x - first_x) * (last_y - first_y) for first_x, first_y, last_x, last_y in regions) / (gray.shape[0] * gray.shape[1]) })
+                status['roi_searches'] += 1
+                self._marker_tracks[cam_name] = self._update_marker_tracks(tracks, markers)
+                return markers
+            reason = 'missing'
+        markers = self._detect_markers(gray)
+        status.update({ 'mode': 'full', 'reason': reason, 'frames_since_full_search': 0, 'searched_fraction': 1.0 })
+        status['full_searches'] += 1
+        self._marker_tracks[cam_name] = self._update_marker_tracks(tracks, markers)
+        return markers
+
+    def _update_marker_tracks(self, tracks, markers):
+        new_tracks = {}
+        for marker in markers:
+            motion = (0, 0)
+            if marker['id'] in tracks:
+                previous_center = tracks[marker['id']]['center']
+                motion = (marker['center'][0] - previous_center[0], marker['center'][1] - previous_center[1])
+            new_tracks[marker['id']] = { 'center': marker['center'], 'size': marker['size'], 'motion': motion, 'missed': 0 }
+        for marker_id, track in tracks.items():
+            if marker_id not in new_tracks and track['missed'] + 1 < self._full_search_interval:
+                new_tracks[marker_id] = dict(track, motion = (0, 0), missed = track['missed'] + 1)   #Kept for a while, so the frames until it is back are searched fully
+        return new_tracks
+
+    def _get_search_regions(self, tracks, frame_shape):
+        regions = []
+        for track in tracks.values():
+            center_x = track['center'][0] + track['motion'][0]
+            center_y = track['center'][1] + track['motion'][1]
+            reach = int(track['size'] * self._search_padding) + abs(track['motion'][0]) + abs(track['motion'][1])
+            regions.append((max(center_x - reach, 0), max(center_y - reach, 0), min(center_x + reach, frame_shape[1]), min(center_y + reach, frame_shape[0])))
+        return self._merge_regions(regions)
+
+    def _merge_regions(self, regions):
+        merged_regions = []
+        for region in sorted(regions):
+            for index, merged_region in enumerate(merged_regions):
+                if region[0] < merged_region[2] and merged_region[0] < region[2] and region[1] < merged_region[3] and merged_region[1] < region[3]:
+                    merged_regions[index] = (min(region[0], merged_region[0]), min(region[1], merged_region[1]), max(region[2], merged_region[2]), max(region[3], merged_region[3]))
+                    break
+            else:
+                merged_regions.append(region)
+        if len(merged_regions) < len(regions):                                  #A merged region can overlap another one now
+            return self._merge_regions(merged_regions)
+        return merged_regions
+
     def _get_max_distance_between_points(self, points):
         max_distance = 0
         for first_index in range(len(points)):
@@ -48,17 +179,47 @@ class MarkerDetection:
 
 
     def get_robot_ellipses(self, cam, frame, markers):
-        sub_frames = self._get_sub_frames(frame, markers)
-        robot_ellipses = []
-        for index, sub_frame in enumerate(sub_frames):
-            ellipses = self._get_ellipses_in_frame(cam, sub_frame)
-            ellipse = self._get_ellipse_in_ellipses(ellipses, sub_frame)
-            norm_ellipse = self._normalize_ellipse(ellipse, markers, index)
-            robot_ellipse = RobotEllipse(norm_ellipse, None, 0, 0, markers[index]['id'])
-            robot_ellipses.append(robot_ellipse)
-        return robot_ellipses
-
-    def _get_sub_frames(self, frame, markers):
+        context = frame_context(frame, cam.get_clahe)
+        sub_frames = self._get_sub_frames(context, markers)
+        if self._ellipse_workers == None:
+            return [self._get_robot_ellipse(cam, sub_frame, markers, index) for index, sub_frame in enumerate(sub_frames)]
+        return self._map_in_order(self._get_robot_ellipse, [(cam, sub_frame, markers, index) for index, sub_frame in enumerate(sub_frames)])
+
+    def _get_robot_ellipse(self, cam, sub_frame, markers, index):
+        ellipses = self._get_ellipses_in_frame(cam, sub_frame, markers[index]['id'])
+        ellipse = self._get_ellipse_in_ellipses(ellipses, sub_frame)
+        norm_ellipse = self._normalize_ellipse(ellipse, markers, index)
+        return RobotEllipse(norm_ellipse, None, 0, 0, markers[index]['id'])
+
+    def _map_in_order(self, function, argument_list):
+        #Results in the order of argument_list, at most max_queued_markers calls are submitted and not yet done
+        executor = self._get_executor()
+        free_slots = threading.BoundedSemaphore(self._max_queued_markers)
+        futures = []
+        for arguments in argument_list:
+            free_slots.acquire()
+            future = executor.submit(function, *arguments)
+            future.add_done_callback(lambda _: free_slots.release())
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._ellipse_workers)
+            return self._executor
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def __del__(self):
+        self.close()
+
+    def _get_sub_frames(self, context, markers):
+        frame = context.frame()
         sub_frames = []
         for marker in markers:
             center = marker['center']
@@ -76,17 +237,17 @@ class MarkerDetection:
             if ending_point[1] < 0: ending_point = (ending_point[0], 0)
             elif ending_point[1] >= frame.shape[0]: ending_point = (ending_point[0], frame.shape[0] - 1)
 
-            sub_frame = frame[starting_point[1]:ending_point[1], starting_point[0]:ending_point[0]]
+            sub_frame = context.sub_context(starting_point, ending_point)
             sub_frames.append(sub_frame)
         return sub_frames
 
-    def _get_ellipses_in_frame(self, cam, frame):
-        ellipses = self.special_ellipses.get_raw_ellipses(cam, frame)
+    def _get_ellipses_in_frame(self, cam, frame, track_key = None):
+        ellipses = self.special_ellipses.get_raw_ellipses(cam, frame, track_key)  #Tracked per marker when full_detection_interval is set
         return ellipses
 
     def _get_ellipse_in_ellipses(self, ellipses, frame):
         ellipse_error = { 'ellipse': ellipses[0], 'error': 100000 }
-        frame_size = frame.shape
+        frame_size = frame.shape()
         for ellipse in ellipses:
             size_error = abs(ellipse.height()*2 - frame_size[0]) + abs(ellipse.width()*2 - frame_size[1])
             error = size_error
@@ -110,6 +271,101 @@ class MarkerDetection:
         rvec, tvec, _ = aruco.estimatePoseSingleMarkers(corners, marker_size/100, camera_matrix, distortion_coefficients)
         return rvec, tvec
 
+    def calc_rotation_translation_matrices(self, corners_list, marker_sizes, cam, marker_ids = None):
+        #All markers of one frame, one estimatePoseSingleMarkers call per marker size. (N, 1, 3) arrays in input order.
+        #With pose_warm_start and marker_ids, markers with a cached pose are refined from it and only the rest is solved cold.
+        #A warm pose is accepted while it reprojects at most max_reprojection_error worse than the cached (last accepted) pose
+        camera_matrix = cam.get_cam_matrix()
+        distortion_coefficients = cam.get_distortion_coeff()
+        marker_sizes = np.asarray(marker_sizes, dtype=np.float64)
+        rvecs = np.zeros((len(marker_sizes), 1, 3))
+        tvecs = np.zeros((len(marker_sizes), 1, 3))
+
+        reprojection_errors = np.zeros(len(marker_sizes))
+        cold_indices = np.arange(len(marker_sizes))
+        use_cache = self._pose_warm_start and marker_ids is not None
+        if use_cache:
+            pose_cache = self._pose_cache.setdefault(cam.get_name(), {})
+            statistics = self._pose_statistics.setdefault(cam.get_name(), { 'held': 0, 'warm': 0, 'fallback': 0, 'cold': 0 })
+            cold = []
+            for index, marker_id in enumerate(marker_ids):
+                cached_pose = pose_cache.get(marker_id)
+                pose = None
+                if cached_pose != None and cached_pose[0] == marker_sizes[index]:
+                    pose, kind = self._warm_start_pose(corners_list[index], marker_sizes[index], cached_pose, camera_matrix, distortion_coefficients)
+                    statistics[kind] += 1
+                if pose == None:
+                    cold.append(index)
+                    continue
+                rvecs[index], tvecs[index], reprojection_errors[index] = pose
+            statistics['cold'] += len(cold)
+            cold_indices = np.array(cold, dtype=np.intp)
+
+        for marker_size in np.unique(marker_sizes[cold_indices]):
+            indices = cold_indices[marker_sizes[cold_indices] == marker_size]
+            size_corners = [corners_list[index] for index in indices]
+            rvec, tvec, _ = aruco.estimatePoseSingleMarkers(size_corners, marker_size/100, camera_matrix, distortion_coefficients)
+            rvecs[indices] = np.asarray(rvec).reshape(-1, 1, 3)
+            tvecs[indices] = np.asarray(tvec).reshape(-1, 1, 3)
+
+        if use_cache:
+            for index in cold_indices:                                          #Reference for the next warm start of these markers
+                object_points = self._marker_object_points(marker_sizes[index]/100)
+                image_points = np.asarray(corners_list[index], dtype=np.float64).reshape(4, 2)
+                reprojection_errors[index] = self._reprojection_error(object_points, image_points, rvecs[index], tvecs[index],
+                                                                      camera_matrix, distortion_coefficients)
+            for index, marker_id in enumerate(marker_ids):
+                pose_cache[marker_id] = (marker_sizes[index], rvecs[index].copy(), tvecs[index].copy(), reprojection_errors[index])
+        return rvecs, tvecs
+
+    def _warm_start_pose(self, corners, marker_size, cached_pose, camera_matrix, distortion_coefficients):
+        #Returns (pose, 'held') if the cached pose still explains the corners, else (pose, 'warm') from an iterative solvePnP
+        #seeded with it, or (None, 'fallback') if that fails, ends behind the camera or reprojects clearly worse than the
+        #cached pose did on its own frame. pose is (rvec, tvec, reprojection error)
+        object_points = self._marker_object_points(marker_size/100)
+        image_points = np.asarray(corners, dtype=np.float64).reshape(4, 2)
+        rvec = cached_pose[1].reshape(3, 1).copy()
+        tvec = cached_pose[2].reshape(3, 1).copy()
+        if self._pose_hold_error != None:
+            hold_error = self._reprojection_error(object_points, image_points, rvec, tvec, camera_matrix, distortion_coefficients)
+            if hold_error <= self._pose_hold_error:
+                return (rvec.reshape(1, 3), tvec.reshape(1, 3), hold_error), 'held'
+
+        found, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, distortion_coefficients, rvec, tvec,
+                                         useExtrinsicGuess = True, flags = cv2.SOLVEPNP_ITERATIVE)
+        if not found or tvec[2][0] <= 0:
+            return None, 'fallback'
+        warm_error = self._reprojection_error(object_points, image_points, rvec, tvec, camera_matrix, distortion_coefficients)
+        if warm_error > cached_pose[3] + self._max_reprojection_error:
+            return None, 'fallback'
+        return (rvec.reshape(1, 3), tvec.reshape(1, 3), warm_error), 'warm'
+
+    def _reprojection_error(self, object_points, image_points, rvec, tvec, camera_matrix, distortion_coefficients):
+        projected_points, _ = cv2.projectPoints(object_points, rvec, tvec, camera_matrix, distortion_coefficients)
+        return math.sqrt(np.mean(np.sum((projected_points.reshape(4, 2) - image_points)**2, axis=1)))     #RMS over the corners in pixels
+
+    def _marker_object_points(self, side_length):
+        #Corner order of estimatePoseSingleMarkers: top left, top right, bottom right, bottom left around the marker center
+        half = side_length / 2
+        return np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]], dtype=np.float64)
+
+    def get_pose_statistics(self, cam):
+        #Markers kept at their cached pose ('held'), solved from it ('warm'), rejected warm starts ('fallback') and cold solves for cam
+        return dict(self._pose_statistics.get(cam.get_name(), {}))
+
+    def reset_pose_cache(self, cam = None):
+        if cam == None:
+            self._pose_cache = {}
+        else:
+            self._pose_cache.pop(cam.get_name(), None)
+
+    def calc_distances_and_angles(self, corners_list, marker_sizes, cam, marker_ids = None):
+        #Distance (in marker size units, the translation is in meters) and rotation about z in degrees of every marker
+        rvecs, tvecs = self.calc_rotation_translation_matrices(corners_list, marker_sizes, cam, marker_ids)
+        distances = np.linalg.norm(tvecs[:, 0, :] * 100, axis=1)
+        angles = np.degrees(rvecs[:, 0, 2])
+        return distances, angles, rvecs, tvecs
+
 
 
 
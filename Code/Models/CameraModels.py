@@ -1,8 +1,10 @@
 from Visualizers import RobotVisualization
+from FramePreprocessing import create_clahe, FrameContext
 
 import math
 import cv2
 import numpy as np
+import threading
 
 
 class CameraInfo:
@@ -15,6 +17,7 @@ class CameraInfo:
         self.focal_length = None
         self.focus = None
         self.radial_distortion = None
+        self.parameter_version = 0                                              #Counts changes of the view degrees, for caches of derived values
         self._setup_camera_parameters(internal_properties)
 
     def _setup_camera_parameters(self, internal_properties):
@@ -53,6 +56,7 @@ class CameraInfo:
     def set_vertical_view_degree(self, degree, type = ''):
         if type == 'rad' or type == 'RAD': self.view_degrees_vertical  = math.degrees(degree)
         else: self.view_degrees_vertical = degree
+        self.parameter_version += 1
 
     def get_horizontal_view_degrees(self, type = ''):
         if type == 'deg' or type == 'DEG': return self.view_degrees_horizontal
@@ -62,6 +66,10 @@ class CameraInfo:
     def set_horizontal_view_degree(self, degree, type = ''):
         if type == 'rad' or type == 'RAD': self.view_degrees_horizontal  = math.degrees(degree)
         else: self.view_degrees_horizontal = degree
+        self.parameter_version += 1
+
+    def get_parameter_version(self):
+        return self.parameter_version
 
     def get_focus(self):
         return self.focus
@@ -87,10 +95,22 @@ class CameraBase:
         self.angle = None
         self.rotation = None
         self.visualizer = RobotVisualization(self.name)
+        self.clahe = threading.local()
+        self.cam_matrix = None                                                  #(frame size, matrix), rebuilt when the frame size changes
+        self.distortion_coefficients = None
         self._init(cam_info, cam_name)
         self.width = None
         self.height = None
 
+    def __getstate__(self):                                                     #For process camera workers, the thread local CLAHE is made again
+        state = self.__dict__.copy()
+        del state['clahe']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clahe = threading.local()
+
     def _init(self, cam_info, cam_name):
         self.address = self._get_address(cam_info)
 
@@ -100,6 +120,16 @@ class CameraBase:
     def get_frame(self):
         raise Exception("get_frame() is a pure function. Overload it to remove exception")
 
+    def get_frame_context(self, frame = None):
+        if frame is None:
+            frame = self.get_frame()
+        return FrameContext(frame, self.get_clahe)
+
+    def get_clahe(self):
+        if getattr(self.clahe, 'instance', None) == None:                       #One CLAHE per camera and thread, reused for every frame
+            self.clahe.instance = create_clahe()
+        return self.clahe.instance
+
     def get_init_status(self):
         return self.init_status
 
@@ -142,6 +172,9 @@ class CameraBase:
     def get_cam_info(self):
         return self.cam_info
 
+    def get_parameter_version(self):
+        return self.cam_info.get_parameter_version()
+
     def get_size_from_known_degrees(self, type = ''):
         if self.get_cam_info().get_vertical_view_degrees != None:
             return self.get_height()
@@ -168,16 +201,24 @@ class CameraBase:
 
     def get_cam_matrix(self):
         image_size = self.get_frame_size()
+        if self.cam_matrix == None or self.cam_matrix[0] != image_size:
+            self.cam_matrix = (image_size, self._create_cam_matrix(image_size))
+        return self.cam_matrix[1]
+
+    def _create_cam_matrix(self, image_size):
         image_center = (image_size[0]/2, image_size[1]/2)
         camera_matrix = [[image_size[0], 0,             image_center[0]], \
                          [0,             image_size[1], image_center[1]], \
                          [0,             0,             1]]
         np_camera_matrix = np.array(camera_matrix)
+        np_camera_matrix.setflags(write=False)                                  #Shared by every caller
         return np_camera_matrix
 
     def get_distortion_coeff(self):
-        distortion_coefficients = np.zeros((5, 1))
-        return distortion_coefficients
+        if self.distortion_coefficients is None:
+            self.distortion_coefficients = np.zeros((5, 1))
+            self.distortion_coefficients.setflags(write=False)
+        return self.distortion_coefficients
 
 
 
@@ -196,6 +237,21 @@ class Camera(CameraBase):
             self.capture.release()
             cv2.destroyWindow(self.name)
 
+    def __getstate__(self):                                                     #A capture can not be pickled, the copy opens the camera again
+        state = super().__getstate__()
+        state['capture'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._init_cam(self.cam_info, self.name)
+
+    def release(self):
+        #Frees the device, e.g. before a camera worker process opens it
+        if self.capture != None:
+            self.capture.release()
+            self.capture = None
+
     def _init_cam(self, cam_info, cam_name):
         self.capture = self._start_cam(self.address, cam_name)
         self.init_status = self._get_init_status(self.capture)
@@ -1,23 +1,61 @@
-import random
+import threading
 import math
 import cv2
+import numpy as np
+
+
+
+_ellipse_id_lock = threading.Lock()
+_next_ellipse_id = 0
+
+def reserve_ellipse_ids(count = 1):
+    #Hands out consecutive ids, so ellipses (and batches of them) never share an id within the process
+    global _next_ellipse_id
+    with _ellipse_id_lock:
+        first_id = _next_ellipse_id
+        _next_ellipse_id += count
+    return first_id
+
+
+def compact_edge_pixels(edge_pixels):
+    #Integer pixel coordinates are kept as an (N, 2) int16 array, non-integer ones (e.g. centered edges) keep their precision
+    edge_array = np.asarray(edge_pixels)
+    if edge_array.size == 0:
+        return np.zeros((0, 2), dtype=np.int16)
+    if edge_array.dtype.kind in 'iub':
+        return edge_array.astype(np.int16, copy=False).reshape(-1, 2)
+    return edge_array.reshape(-1, 2)
 
 
 
 class Ellipse:
-    def __init__(self, edge_pixels, center, width, height, rotation):
+    __slots__ = ('_height', '_width', '_center', '_rotation', '_edge_pixels', '_conic', '_id')
+
+    def __init__(self, edge_pixels, center, width, height, rotation, conic = None):
         self._height = height
         self._width = width
         self._center = center   #x, y
         self._rotation = rotation
-        self._edge_pixels = edge_pixels
-        self._id = random.randint(0,1000000000)
+        self._edge_pixels = compact_edge_pixels(edge_pixels)
+        self._conic = conic     #Least square result [r0, r1, r2, r3, r4] the ellipse was fitted from (None if not fitted)
+        self._id = reserve_ellipse_ids()
 
     def __eq__(self, secondary_ellipse):
         if isinstance(secondary_ellipse, Ellipse):
             return self.id() == secondary_ellipse.id()
         return False
 
+    def __hash__(self):
+        return hash(self.id())
+
+    def __setstate__(self, state):
+        #Ids are only unique within a process, so an ellipse coming from another process (e.g. a worker) gets a new one
+        slot_state = state[1] if isinstance(state, tuple) else state
+        for name, value in slot_state.items():
+            setattr(self, name, value)
+        if '_id' in slot_state:
+            self._id = reserve_ellipse_ids()
+
     def height(self):
         return self._height
 
@@ -47,6 +85,16 @@ class Ellipse:
     def edge_pixels(self):
         return self._edge_pixels
 
+    def conic(self):
+        return self._conic
+
+    def release_edge_pixels(self, step = 0):
+        #step 0 drops the edge pixels, step N keeps every N'th pixel (e.g. for visualization)
+        if step > 0:
+            self._edge_pixels = self._edge_pixels[::step].copy()
+        else:
+            self._edge_pixels = compact_edge_pixels([])
+
     def id(self):
         return self._id
 
@@ -60,7 +108,108 @@ class Ellipse:
 
 
 
+class EllipseBatch:
+    #Structure of arrays for all ellipses found in one frame. The ellipses handed out are EllipseView objects reading
+    #from these arrays, the edge pixels of ellipse i are edge_pixels[edge_offsets[i]:edge_offsets[i+1]]
+    def __init__(self, centers, widths, heights, rotations, edges = None, conics = None):
+        self.centers = np.ascontiguousarray(centers, dtype=np.float64).reshape(-1, 2)
+        self.widths = np.ascontiguousarray(widths, dtype=np.float64)
+        self.heights = np.ascontiguousarray(heights, dtype=np.float64)
+        self.rotations = np.ascontiguousarray(rotations, dtype=np.float64)
+        self.conics = np.ascontiguousarray(conics, dtype=np.float64).reshape(-1, 5) if conics is not None else None
+        self.edge_pixels, self.edge_offsets = self._pack_edges(edges, len(self.widths))
+        self._first_id = reserve_ellipse_ids(len(self.widths))
+
+    def __len__(self):
+        return len(self.widths)
+
+    def _pack_edges(self, edges, nr_of_ellipses):
+        if edges is None or nr_of_ellipses == 0:
+            return compact_edge_pixels([]), np.zeros(nr_of_ellipses + 1, dtype=np.int64)
+        edge_lengths = [len(edge) for edge in edges]
+        edge_offsets = np.concatenate(([0], np.cumsum(edge_lengths))).astype(np.int64)
+        edge_pixels = compact_edge_pixels(np.concatenate([np.asarray(edge).reshape(-1, 2) for edge in edges]))
+        return edge_pixels, edge_offsets
+
+    def release_edges(self, keep_indices = (), step = 0, drop_others = True):
+        #keep_indices keep a decimated subset (every step'th pixel, none for step 0) of their edge pixels. The other ellipses
+        #lose theirs with drop_others (e.g. the rejected ellipses after filtering), else they keep them all
+        released_edges = { index: self.edges(index)[::step] if step > 0 else self.edge_pixels[:0] for index in keep_indices }
+        other_edges = (lambda index: self.edge_pixels[:0]) if drop_others else self.edges
+        edges = [released_edges[index] if index in released_edges else other_edges(index) for index in range(len(self))]
+        self.edge_pixels, self.edge_offsets = self._pack_edges(edges, len(self))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._first_id = reserve_ellipse_ids(len(self))                         #See Ellipse.__setstate__
+
+    def first_id(self):
+        return self._first_id
+
+    def edges(self, index):
+        return self.edge_pixels[self.edge_offsets[index]:self.edge_offsets[index + 1]]
+
+    def view(self, index):
+        return EllipseView(self, index)
+
+    def views(self, indices = None):
+        if indices is None:
+            indices = range(len(self))
+        return [EllipseView(self, index) for index in indices]
+
+
+
+class EllipseView(Ellipse):
+    #Ellipse accessor API on top of one row of an EllipseBatch, without copying the data
+    __slots__ = ('_batch', '_index')
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    def height(self):
+        return float(self._batch.heights[self._index])
+
+    def width(self):
+        return float(self._batch.widths[self._index])
+
+    def center(self, type = ''):
+        center = self._batch.centers[self._index]
+        if type == '': return (float(center[0]), float(center[1]))
+        elif type.lower() == 'x': return float(center[0])
+        elif type.lower() == 'y': return float(center[1])
+        else: return (float(center[0]), float(center[1]))
+
+    def rotation(self, type = 'deg'):
+        rotation = float(self._batch.rotations[self._index])
+        if type.lower() == 'rad': return math.radians(rotation)
+        else: return rotation
+
+    def edge_pixels(self):
+        return self._batch.edges(self._index)
+
+    def conic(self):
+        if self._batch.conics is None:
+            return None
+        return self._batch.conics[self._index]
+
+    def release_edge_pixels(self, step = 0):
+        self._batch.release_edges([self._index], step, drop_others = False)   #Only this ellipse's pixels, like Ellipse.release_edge_pixels
+
+    def id(self):
+        return self._batch.first_id() + self._index
+
+    def batch(self):
+        return self._batch
+
+    def batch_index(self):
+        return self._index
+
+
+
 class RobotEllipse:
+    __slots__ = ('super_ellipse', 'sub_ellipses', 'angle', 'distance', 'id')
+
     def __init__(self, super_ellipse = None, sub_ellipses = None, distance = 0, angle = 0, id = None):
         self.super_ellipse = super_ellipse
         self.sub_ellipses = []
@@ -108,7 +257,9 @@ class RobotEllipse:
             return self.id
 
     def valid(self):
-        return len(self.sub_ellipses) > 0
+        if self.sub_ellipses != None:
+            return len(self.sub_ellipses) > 0
+        return self.id != None                                                  #Marker ellipses carry their id instead of sub ellipses
 
     def set_angle(self, angle, type = 'deg'):
         if type.lower() == 'deg': self.angle = angle
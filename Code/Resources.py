@@ -77,6 +77,10 @@ class CircleResources:
     def valid_id(self, id):
         return id in self.circles
 
+    def get_all_ids(self):
+        ids = [key for key in self.circles]
+        return ids
+
 
 
 class CameraInfoResouces:
@@ -2,34 +2,47 @@ from Models.CameraModels import Camera
 from Models.EllipseModels import Ellipse
 from EllipseDetection import *
 from Calibration import CameraCalibration
-from SpecialEllipses import SpecialEllipses
+from SpecialEllipses import SpecialEllipses, RobotEllipseAccumulator
 from Tracking import RobotTracking as RT
 from MarkerDetection import MarkerDetection
 from Models.SquareModels import RobotSquare
+from EventLog import EventLog
+from StageTimers import StageTimers
+from CameraWorkers import CameraWorker
 
 import cv2
+import logging
 import operator
 import random
+import time
 
 
 
 class RobotTracking:
-    def __init__(self, marker_info_object, robot_info_object, cam_info_list = [], cameras = [], visual_feedback = False):
+    def __init__(self, marker_info_object, robot_info_object, cam_info_list = [], cameras = [], visual_feedback = False, event_log = None, stage_timers = None,
+                 camera_workers = None):
         self.marker_info = marker_info_object
         self.robot_info = robot_info_object
         self.visual_feedback = visual_feedback
-        self.marker_detection = MarkerDetection()
-        self.cam_calibration = CameraCalibration()
+        self.event_log = event_log if event_log != None else EventLog()
+        self.stage_timers = stage_timers if stage_timers != None else StageTimers(enabled = False)
+        get_all_ids = getattr(self.marker_info, 'get_all_ids', None)            #Optional in the CircleResources interface, without it every marker is decoded
+        self.marker_detection = MarkerDetection(marker_ids = get_all_ids() if get_all_ids != None else None)
+        self.special_ellipses = self.marker_detection.special_ellipses
+        self.cam_calibration = CameraCalibration(self.event_log)
         self.cameras = self._init_cameras(cam_info_list, cameras)
         self.robot_tracking = RT(self.marker_info, self.robot_info)
+        self.camera_workers = camera_workers                                    #None: find_robots captures every camera itself, 'thread'/'process': one worker per camera
+        self._workers = self._start_camera_workers(camera_workers)
 
     def _init_cameras(self, cam_info_list, cameras):
         cameras = self._setup_cameras(cam_info_list, cameras)
         for cam in cameras:
             self._calibrate_camera_focus(cam)
             self._calculate_missing_view_degree(cam)
-            calibration_markers = self._get_squares_from_group(cam, cam.get_frame(), 'calibration')
-            for marker in calibration_markers: marker.print()
+            calibration_markers = self._get_squares_from_group(cam, cam.get_frame_context(), 'calibration', 'calibration_')
+            for marker in calibration_markers:
+                self.event_log.info(None, "%s: calibration marker %s at %s, distance %s, angle %s", cam.get_name(), marker.get_id(), marker.get_center(), marker.get_distance(), marker.get_angle())
 
             #calibration_ellipses = self._generate_stub_ellipses()
             #self.cam_calibration.calibrate(cam, calibration_markers, self.marker_info)
@@ -74,7 +87,7 @@ class RobotTracking:
         if self.visual_feedback == True:
             print("Setting cam up: ")
 
-        frame = cam.get_frame()
+        frame = cam.get_frame_context()                                         #The same frame is searched at every focus level
         focus_range = [0, 255]
         step_size = int(focus_range[1] / 8)
 
@@ -103,48 +116,118 @@ class RobotTracking:
         return camera_list
 
     def _get_calibration_ellipses(self, cam, frame_iterations):
-        all_ellipses = self._get_robot_ellipses_over_N_iterations(cam, frame_iterations, 'calibration')
-        cali_robot_ellipses = self.special_ellipses.find_standard_representations(all_ellipses, frame_iterations)
+        accumulator = RobotEllipseAccumulator()                                 #Folds in one frame at a time, memory does not grow with frame_iterations
+        nr_of_ellipses = 0
+        for _ in range(frame_iterations):
+            frame = cam.get_frame_context()
+            robot_ellipses = self._get_ellipses_from_group(cam, frame, 'calibration', 'calibration_')
+            accumulator.add(robot_ellipses)
+            nr_of_ellipses += len(robot_ellipses)
+        nr_of_clusters = round(nr_of_ellipses / frame_iterations)               #Ellipses seen per frame, like find_standard_representations
+        cali_robot_ellipses = accumulator.get_robot_ellipses(nr_of_clusters)
         return cali_robot_ellipses
 
     def _get_robot_ellipses_over_N_iterations(self, cam, nr_of_iterations, group = 'all'):
         all_ellipses = []
         for _ in range(nr_of_iterations):
-            frame = cam.get_frame()
-            robot_ellipses = self._get_ellipses_from_group(cam, frame, 'calibration')
+            frame = cam.get_frame_context()
+            robot_ellipses = self._get_ellipses_from_group(cam, frame, 'calibration', 'calibration_')
             all_ellipses.extend(robot_ellipses)
         return all_ellipses
 
 
 
 
+    def _start_camera_workers(self, camera_workers):
+        if camera_workers == None:
+            return None
+        if camera_workers == 'thread':
+            detect = self._detect_in_camera                                     #Per camera state in MarkerDetection is kept by camera name
+        else:
+            detect = _CameraDetection(self.marker_info, self.robot_info, self.marker_detection, self.event_log, self.stage_timers, self.visual_feedback)
+        workers = []
+        for cam in self.cameras:
+            if camera_workers == 'process' and isinstance(cam, Camera):
+                cam.release()                                                   #The worker process opens the device itself
+            workers.append(CameraWorker(cam, detect, camera_workers).start())
+        return workers
+
+    def close(self):
+        if self._workers != None:
+            for worker in self._workers:
+                worker.stop()
+            self._workers = None
+
     def find_robots(self):
+        #With camera workers the latest result of every camera is used as it is. Every position carries the 'age' (seconds
+        #since its frame was captured) and the 'camera' of the result it comes from, the youngest one is kept per model
         all_robot_positions = {}
-        for cam in self.cameras:
-            frame = cam.get_frame()
-            robot_squares = self._get_squares_from_group(cam, frame, 'calibration')
+        for cam, camera_result in zip(self.cameras, self._get_camera_results()):
+            if camera_result == None:                                           #No frame from this camera yet
+                continue
+            age = time.time() - camera_result['time']
+            robot_squares = camera_result['result']['squares']
             #robot_positions = self.robot_tracking.get_positions(robot_ellipses)
-            #self._append_positions_to_dict(all_robot_positions, robot_positions)
-            status = self._visualize(cam, frame, robot_squares)
+            robot_positions = self._get_square_positions(robot_squares)
+            self._append_positions_to_dict(all_robot_positions, robot_positions, age, cam.get_name())
+            with self.stage_timers.stage(cam.get_name(), 'visualize'):
+                status = self._visualize(cam, camera_result['result']['frame'], robot_squares)
             if status == -1:
                 return -1
         positions = self._concentrate_robot_positions(all_robot_positions)
         return positions
 
+    def _get_camera_results(self):
+        if self._workers == None:
+            return [{ 'result': self._detect_in_camera(cam), 'time': time.time(), 'frames': None } for cam in self.cameras]
+        camera_results = [worker.get_latest() for worker in self._workers]
+        if self.camera_workers == 'process':
+            for cam, camera_result in zip(self.cameras, camera_results):
+                if camera_result != None:
+                    self._import_worker_records(cam, camera_result['result'])
+        return camera_results
+
+    def _import_worker_records(self, cam, result):
+        #Stage durations and log records of a worker process, see _CameraDetection. Importing a result twice changes nothing
+        self.stage_timers.import_durations(cam.get_name(), result['stages'])
+        self.event_log.import_records(cam.get_name(), result['events'])
+
+    def _detect_in_camera(self, cam):
+        with self.stage_timers.stage(cam.get_name(), 'total'):
+            with self.stage_timers.stage(cam.get_name(), 'get_frame'):
+                frame = cam.get_frame_context()
+            robot_squares = self._get_squares_from_group(cam, frame, 'calibration')
+        return { 'squares': robot_squares, 'frame': frame.frame() }
+
+    def get_camera_status(self):
+        #{ cam name: { 'age': seconds since the frame of the latest result was captured, 'frames', 'alive', 'error' } }
+        if self._workers == None:
+            return { cam.get_name(): { 'age': 0.0, 'frames': None, 'alive': True, 'error': None } for cam in self.cameras }
+        return { worker.cam_name: worker.get_status() for worker in self._workers }
+
+    def get_stage_statistics(self, cam = None):
+        #Rolling latencies of the find_robots stages, see StageTimers.get_statistics. Empty unless built with stage_timers
+        return self.stage_timers.get_statistics(cam.get_name() if cam != None else None)
+
     def _concentrate_robot_positions(self, robot_position_map):
         final_positions = []
         for model_key in robot_position_map:
-            position = robot_position_map[model_key][0]
-            final_positions.append({'model': model_key, 'position': position})
+            position = min(robot_position_map[model_key], key=lambda position: position['age'])
+            final_positions.append({'model': model_key, 'position': position['coordinate'], 'age': position['age'], 'camera': position['camera']})
         return final_positions
 
-    def _append_positions_to_dict(self, position_dict, new_positions):
+    def _append_positions_to_dict(self, position_dict, new_positions, age = 0.0, cam_name = None):
         for position in new_positions:
             model = position['name']
             coordinate = position['position']
             if model not in position_dict:
                 position_dict[model] = []
-            position_dict[model].append(coordinate)
+            position_dict[model].append({'coordinate': coordinate, 'age': age, 'camera': cam_name})
+
+    def _get_square_positions(self, robot_squares):
+        #Marker positions as seen from the camera, until the robot positions are worked out from them
+        return [{ 'name': robot_square.get_id(), 'position': { 'center': robot_square.get_center(), 'distance': robot_square.get_distance(),
+                                                               'angle': robot_square.get_angle() } } for robot_square in robot_squares]
 
     def _set_of_robot_models(self, robot_ellipses):
         model_list = [self.marker_info.get_model_by_id(robot_ellipse.get_id()) for robot_ellipse in robot_ellipses]
@@ -167,19 +250,25 @@ class RobotTracking:
                 return -1
         return 1
 
-    def _get_ellipses_from_group(self, cam, frame, ellipse_group):
+    def _get_ellipses_from_group(self, cam, frame, ellipse_group, stage_prefix = ''):
         #robot_ellipses = self.special_ellipses.get_from_frame(cam, frame, self.marker_info)     #THIS IS THE ONLY ONE THAT SHOULD BE SGITED OUT WITH THE NEW METHOD
-        markers = self.marker_detection.get_markers(frame)
-        robot_ellipses = self.marker_detection.get_robot_ellipses(cam, frame, markers)
+        with self.stage_timers.stage(cam.get_name(), stage_prefix + 'get_markers'):
+            markers = self.marker_detection.get_markers(frame, cam)
+        with self.stage_timers.stage(cam.get_name(), stage_prefix + 'ellipses'):
+            robot_ellipses = self.marker_detection.get_robot_ellipses(cam, frame, markers)
         group_ellipses = self._get_ellipses_group(robot_ellipses, ellipse_group)
-        self._fill_in_robot_ellipses_info(group_ellipses, cam)
+        with self.stage_timers.stage(cam.get_name(), stage_prefix + 'ellipse_pose'):
+            self._fill_in_robot_ellipses_info(group_ellipses, cam)
         return group_ellipses
 
-    def _get_squares_from_group(self, cam, frame, group_name):
-        markers = self.marker_detection.get_markers(frame)
+    def _get_squares_from_group(self, cam, frame, group_name, stage_prefix = ''):
+        #stage_prefix keeps the calibration runs of _init_cameras out of the find_robots stages
+        with self.stage_timers.stage(cam.get_name(), stage_prefix + 'get_markers'):
+            markers = self.marker_detection.get_markers(frame, cam)
         robot_squares = self.marker_detection.get_robot_squares(markers)
         group_squares = self._get_square_groups(robot_squares, group_name)
-        self._fill_in_robot_squares_info(group_squares, cam)
+        with self.stage_timers.stage(cam.get_name(), stage_prefix + 'pose'):
+            self._fill_in_robot_squares_info(group_squares, cam)
         return group_squares
 
     def _get_square_groups(self, robot_squares, group_name):
@@ -199,39 +288,34 @@ class RobotTracking:
         return robot_ellipse_group
 
     def _fill_in_robot_ellipses_info(self, robot_ellipses, cam):
-        for robot_ellipse in robot_ellipses:
-            distance = self.special_ellipses.calc_distance(robot_ellipse, cam, self.marker_info)
-            angle = self.special_ellipses.calc_angle(robot_ellipse)
+        if len(robot_ellipses) == 0:
+            return
+        centers = [robot_ellipse.get_center() for robot_ellipse in robot_ellipses]
+        widths = [robot_ellipse.get_width() for robot_ellipse in robot_ellipses]
+        heights = [robot_ellipse.get_height() for robot_ellipse in robot_ellipses]
+        ids = [robot_ellipse.get_id() for robot_ellipse in robot_ellipses]
+        distances, angles = self.special_ellipses.calc_distances_and_angles(cam, centers, widths, heights, ids, self.marker_info)
+        for robot_ellipse, distance, angle in zip(robot_ellipses, distances.tolist(), angles.tolist()):
             robot_ellipse.set_distance(distance)
             robot_ellipse.set_angle(angle)
 
     def _fill_in_robot_squares_info(self, robot_squares, cam):
-        for robot_square in robot_squares:
-            corners = robot_square.get_corners()
-            square_side_length = self.marker_info.get_size_by_id(robot_square.get_id())
-            rotation_vector, translation_vector = self.marker_detection.calc_rotation_translation_matrix(corners, square_side_length, cam)
-
-            rot_vec = rotation_vector
-            rot_mat = cv2.Rodrigues(rot_vec[0][0])
-            print("(" + str(robot_square.get_id()) + ") Rotation Matrix: " + str(rot_vec))
-            print("(" + str(robot_square.get_id()) + ") Translation Matrix: " + str(translation_vector))
-            print(rot_mat)
-            print("----------")
-
-            distance =  self._calculate_distance_to_square(rotation_vector, translation_vector)
-            angle =  self._calculate_square_angle(rotation_vector)
-
-            robot_square.set_distance(distance)
-            robot_square.set_angle(angle, 'deg')
-
-    def _calculate_distance_to_square(self, rotation_matrix, translation_matrix):
-        tmat = translation_matrix[0][0] * 100
-        realDistanceInTvec = self.euclideanDistanceOfTvec(tmat)
-        return realDistanceInTvec
+        if len(robot_squares) == 0:
+            return
+        corners_list = [robot_square.get_corners() for robot_square in robot_squares]
+        square_side_lengths = [self.marker_info.get_size_by_id(robot_square.get_id()) for robot_square in robot_squares]
+        square_ids = [robot_square.get_id() for robot_square in robot_squares]
+        distances, angles, rotation_vectors, translation_vectors = self.marker_detection.calc_distances_and_angles(corners_list, square_side_lengths, cam, square_ids)
 
+        log_poses = self.event_log.is_enabled(logging.DEBUG)                    #Rodrigues is only worth computing for a message that is emitted
+        for index, robot_square in enumerate(robot_squares):
+            self.event_log.record_pose(cam.get_name(), robot_square.get_id(), rotation_vectors[index], translation_vectors[index], distances[index], angles[index])
+            if log_poses:
+                self.event_log.debug(('pose', cam.get_name(), robot_square.get_id()), "%s: (%s) rotation vector: %s, translation vector: %s, rotation matrix: %s",
+                                     cam.get_name(), robot_square.get_id(), rotation_vectors[index], translation_vectors[index], cv2.Rodrigues(rotation_vectors[index][0])[0])
 
-    def _calculate_square_angle(self, rotation_matrix):
-        return (rotation_matrix[0][0][2] / math.pi * 180)
+            robot_square.set_distance(distances[index])
+            robot_square.set_angle(angles[index], 'deg')
 
     def euclideanDistanceOfTvecs(self, tvec1, tvec2):
         return math.sqrt(math.pow(tvec1[0]-tvec2[0], 2) + math.pow(tvec1[1]-tvec2[1], 2) + math.pow(tvec1[2]-tvec2[2], 2))
@@ -245,4 +329,41 @@ class RobotTracking:
 
 
 
+class _CameraDetection:
+    #What a camera worker process runs: a RobotTracking of its own, made in that process on the first frame. It gets copies
+    #of the parent's MarkerDetection, EventLog and StageTimers (their settings, not their state), and every result carries
+    #what the copies timed and logged back for _import_worker_records
+    def __init__(self, marker_info, robot_info, marker_detection, event_log, stage_timers, keep_frame):
+        self.marker_info = marker_info
+        self.robot_info = robot_info
+        self.marker_detection = marker_detection
+        self.event_log = event_log
+        self.stage_timers = stage_timers
+        self.keep_frame = keep_frame                                            #Frames are only sent back to be visualized
+        self.tracking = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tracking'] = None
+        return state
+
+    def __call__(self, cam):
+        if self.tracking == None:
+            self.event_log.forward_messages()                                   #Logging is not set up in a spawned process
+            self.tracking = RobotTracking(self.marker_info, self.robot_info, event_log = self.event_log, stage_timers = self.stage_timers)
+            self.tracking.marker_detection = self.marker_detection
+            self.tracking.special_ellipses = self.marker_detection.special_ellipses
+        result = self.tracking._detect_in_camera(cam)
+        if not self.keep_frame:
+            result['frame'] = None
+        result['stages'] = self.stage_timers.export_durations(cam.get_name())
+        result['events'] = self.event_log.export_records()
+        return result
+
+
+
+
+
+
+
 #Nothing
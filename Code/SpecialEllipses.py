@@ -1,18 +1,49 @@
 from EllipseDetection import *
+from FramePreprocessing import frame_context
 
-from sklearn.cluster import KMeans, MeanShift, estimate_bandwidth
 import cv2
 import operator
+import time
+import weakref
+import threading
 
 class SpecialEllipses:
-    def __init__(self, error_threshold):
-        self.ellipse_detector = EllipseDetection(error_threshold)
-        self.ellipse_filtering = EllipseFiltering(RobotEllipseRules())
-
-    def get_raw_ellipses(self, cam, frame):
-        color_corrected_frame = self._correct_colors_in_frame(frame)
-        ellipses = self.ellipse_detector.detect(color_corrected_frame)
-        return ellipses
+    def __init__(self, error_threshold, edge_retention = 'full', pyramid_depth = 1, full_detection_interval = None, track_band = 6, rectangle_check = False):
+        self.ellipse_detector = EllipseDetection(error_threshold, edge_retention = edge_retention, pyramid_depth = pyramid_depth)
+        self.ellipse_filtering = EllipseFiltering(RobotEllipseRules(rectangle_check = rectangle_check))    #rectangle_check needs edge pixels, see edge_retention
+        self._full_detection_interval = full_detection_interval                 #None: detect every frame, N: refit the last ellipses and detect every N'th frame
+        self._track_band = track_band                                           #Pixels an ellipse edge may move between two frames
+        self._tracks = {}                                                       #(cam name, track key) -> { 'ellipses': [...] in full frame coordinates, 'frames': refits since detection }
+        self._tracking_statistics = { 'detections': 0, 'refits': 0, 'lost': 0 }   #lost: refits given up for a detection
+        self._statistics_lock = threading.Lock()                                #Sub frames can be handled by several threads
+        self._camera_constants = weakref.WeakKeyDictionary()                    #cam -> constants of calc_distances_and_angles
+
+    def __getstate__(self):                                                     #For process camera workers, see MarkerDetection
+        state = self.__dict__.copy()
+        del state['_statistics_lock']
+        del state['_camera_constants']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._statistics_lock = threading.Lock()
+        self._camera_constants = weakref.WeakKeyDictionary()
+
+    def get_raw_ellipses(self, cam, frame, track_key = None):                   #frame can be an image or a FrameContext
+        if self._full_detection_interval == None or track_key == None:
+            return self._detect_ellipses(cam, frame)
+        return self._track_ellipses(cam, frame, track_key)
+
+    def get_tracking_statistics(self):
+        with self._statistics_lock:
+            return dict(self._tracking_statistics)
+
+    def _count_tracking(self, name):
+        with self._statistics_lock:
+            self._tracking_statistics[name] += 1
+
+    def reset_tracks(self):
+        self._tracks = {}
 
     def get_from_frame(self, cam, frame, circle_info):
         return self._get_special_ellipses(cam, frame, circle_info)
@@ -27,60 +58,123 @@ class SpecialEllipses:
     def calc_angle(self, robot_ellipse):
         return math.acos(robot_ellipse.get_ratio()) * (180 / math.pi)
 
-    def find_standard_representations(self, robot_ellipses, frame_iterations = 1):
+    def calc_distances_and_angles(self, cam, centers, widths, heights, ids, circle_info):
+        #Same as calc_distance and calc_angle for many ellipses of one camera, centers is (N, 2) like Ellipse.center()
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        widths = np.asarray(widths, dtype=np.float64)
+        heights = np.asarray(heights, dtype=np.float64)
+        constants = self._get_camera_constants(cam)
+        max_sizes = np.maximum(widths, heights)
+        min_sizes = np.minimum(widths, heights)
+        circle_sizes_mm = self._get_circle_sizes_mm(ids, circle_info)
+
+        pixel_lengths_mm = circle_sizes_mm / (max_sizes * 2)
+        direct_image_lengths = constants['size_from_known_degrees'] * pixel_lengths_mm * constants['unit_dist'] / constants['unit_size']
+        dists_from_center_mm = np.hypot(constants['frame_center'][0] - centers[:, 0], constants['frame_center'][1] - centers[:, 1]) * pixel_lengths_mm
+        distances = np.sqrt(direct_image_lengths**2 + dists_from_center_mm**2)
+        angles = np.degrees(np.arccos(min_sizes / max_sizes))
+        return distances, angles
+
+    def _get_camera_constants(self, cam):
+        constants = self._camera_constants.get(cam)
+        if constants == None or constants['version'] != cam.get_parameter_version():
+            view_angle_RAD = cam.get_cam_info().get_known_view_degrees('rad')
+            constants = { 'version': cam.get_parameter_version(),
+                          'size_from_known_degrees': cam.get_size_from_known_degrees(),
+                          'unit_size': math.sin(view_angle_RAD/2),
+                          'unit_dist': math.cos(view_angle_RAD/2),
+                          'frame_center': (cam.get_width()/2, cam.get_height()/2) }
+            self._camera_constants[cam] = constants
+        return constants
+
+    def _get_circle_sizes_mm(self, ids, circle_info):
+        size_by_id = {}
+        for circle_id in ids:
+            if circle_id not in size_by_id:
+                size_by_id[circle_id] = circle_info.get_size_by_id(circle_id)
+        return np.array([size_by_id[circle_id] for circle_id in ids], dtype=np.float64)
+
+    def find_standard_representations(self, robot_ellipses, frame_iterations = 1, max_time = None):
+        accumulator = RobotEllipseAccumulator()
+        if frame_iterations == None:                                            #Number of markers not known, the density clusters are the markers
+            for members in self._auto_find_clusters(robot_ellipses, max_time):
+                accumulator.add_cluster([robot_ellipses[index] for index in members])
+            return accumulator.get_robot_ellipses()
         number_of_cluster = self._estimate_number_of_clusters(len(robot_ellipses), frame_iterations)
-        cluster_centers = self._find_cluster_centers(robot_ellipses, number_of_cluster)
-        cali_robot_ellipses = self._represent_cluster_centers_as_ellipses(robot_ellipses, cluster_centers)
+        accumulator.add(robot_ellipses)
+        cali_robot_ellipses = accumulator.get_robot_ellipses(number_of_cluster)
         return cali_robot_ellipses
 
     def _get_special_ellipses(self, cam, frame, circle_info):
-        color_corrected_frame = self._correct_colors_in_frame(frame)
-        ellipses = self.ellipse_detector.detect(color_corrected_frame)
+        ellipses = self._detect_ellipses(cam, frame)
         special_ellipses = self.ellipse_filtering.filter(ellipses)
-        robot_ellipses = self._convert_ellipses_to_robot_ellipses(special_ellipses, circle_info)
-        robot_ellipses = self._filter_out_double_ellipses(robot_ellipses)
+        hierarchy = EllipseHierarchy(special_ellipses)
+        robot_ellipses = self._convert_ellipses_to_robot_ellipses(hierarchy, circle_info)
+        robot_ellipses = self._filter_out_double_ellipses(hierarchy, robot_ellipses)
         return robot_ellipses
 
-    def _filter_out_double_ellipses(self, robot_ellipses):
+    def _filter_out_double_ellipses(self, hierarchy, robot_ellipses):
+        #An outer ring that holds another robot ellipse is the double edge of that ring, the inner one is kept
         filtered_robot_ellipses = []
-        for robot_ellipse in robot_ellipses:
-            if self._robot_ellipses_inside_of_ellipse(robot_ellipses, robot_ellipse) == False:
+        for index, robot_ellipse in robot_ellipses.items():
+            if self._robot_ellipses_inside_of_ellipse(hierarchy, robot_ellipses, index) == False:
                 filtered_robot_ellipses.append(robot_ellipse)
         return filtered_robot_ellipses
 
-    def _robot_ellipses_inside_of_ellipse(self, robot_ellipses, robot_ellipse):
-        for robot_ellipse_check in robot_ellipses:
-            if robot_ellipse_check != robot_ellipse:
-                inner_ellipse = robot_ellipse_check.get_super_ellipse()
-                outer_ellipse = robot_ellipse.get_super_ellipse()
-                if EllipseHelpFunction.is_ellipse_inside_ellipse(inner_ellipse, outer_ellipse):
-                    return True
+    def _robot_ellipses_inside_of_ellipse(self, hierarchy, robot_ellipses, index):
+        for descendant in hierarchy.descendants(index):
+            if descendant in robot_ellipses:
+                return True
         return False
 
-    def _correct_colors_in_frame(self, frame):
-        gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        clahe_frame = clahe.apply(gray_img)
-        return clahe_frame
+    def _detect_ellipses(self, cam, frame):
+        context = self._get_frame_context(cam, frame)
+        pyramid_depth = self.ellipse_detector.get_pyramid_depth()
+        pyramid = context.pyramid(pyramid_depth) if pyramid_depth > 1 else None   #Color corrected like the frame itself
+        return self.ellipse_detector.detect(context.clahe(), pyramid)
+
+    def _track_ellipses(self, cam, frame, track_key):
+        #Temporal mode: the ellipses of the last frame are refitted close to where they were, a full detection runs
+        #every full_detection_interval frames, when there is nothing to track or when any tracked ellipse can not be
+        #refitted (e.g. a marker that was hidden comes back only with a detection)
+        context = self._get_frame_context(cam, frame)
+        key = (cam.get_name() if cam != None else None, track_key)
+        track = self._tracks.get(key)
+        if track != None and len(track['ellipses']) > 0 and track['frames'] + 1 < self._full_detection_interval:
+            previous_ellipses = self._move_ellipses(track['ellipses'], context.offset(), -1)
+            ellipses = self.ellipse_detector.refit(context.clahe(), previous_ellipses, self._track_band)
+            if len(ellipses) == len(previous_ellipses):
+                self._count_tracking('refits')
+                self._tracks[key] = { 'ellipses': self._move_ellipses(ellipses, context.offset()), 'frames': track['frames'] + 1 }
+                return ellipses
+            self._count_tracking('lost')
+        ellipses = self._detect_ellipses(cam, context)
+        self._count_tracking('detections')
+        self._tracks[key] = { 'ellipses': self._move_ellipses(ellipses, context.offset()), 'frames': 0 }
+        return ellipses
 
-    def _convert_ellipses_to_robot_ellipses(self, ellipses, circle_info):
-        robot_ellipse_list = []
-        for primary_ellipse in ellipses:
-            robot_ellipse = self._create_robot_ellipse(primary_ellipse, ellipses)
+    def _move_ellipses(self, ellipses, offset, direction = 1):
+        #offset is (x, y) of a sub frame in the full frame, the tracks keep only the ellipse parameters
+        row_offset = offset[1] * direction
+        column_offset = offset[0] * direction
+        return [Ellipse([], (ellipse.center('x') + row_offset, ellipse.center('y') + column_offset), ellipse.width(), ellipse.height(), ellipse.rotation())
+                for ellipse in ellipses]
+
+    def _get_frame_context(self, cam, frame):
+        clahe = cam.get_clahe if cam != None else None
+        return frame_context(frame, clahe)
+
+    def _convert_ellipses_to_robot_ellipses(self, hierarchy, circle_info):
+        robot_ellipse_map = {}                                                  #Hierarchy index -> RobotEllipse
+        for index in range(len(hierarchy)):
+            robot_ellipse = self._create_robot_ellipse(hierarchy, index)
             if robot_ellipse.valid() == True and circle_info.valid_id(robot_ellipse.get_id()) == True:
-                robot_ellipse_list.append(robot_ellipse)
-        return robot_ellipse_list
+                robot_ellipse_map[index] = robot_ellipse
+        return robot_ellipse_map
 
-    def _create_robot_ellipse(self, primary_ellipse, ellipses):
-        robot_ellipse = RobotEllipse(super_ellipse=primary_ellipse)
-        for secondary_ellipse in ellipses:
-            if primary_ellipse != secondary_ellipse:
-                if self._if_super_ellipse(primary_ellipse, secondary_ellipse) == True:
-                    robot_ellipse.add_sub_ellipse(secondary_ellipse)
-        return robot_ellipse
-
-    def _if_super_ellipse(self, primary_ellipse, secondary_ellipse):
-        return EllipseHelpFunction.is_ellipse_inside_ellipse(secondary_ellipse, primary_ellipse)
+    def _create_robot_ellipse(self, hierarchy, index):
+        sub_ellipses = [hierarchy[descendant] for descendant in hierarchy.descendants(index)]
+        return RobotEllipse(super_ellipse=hierarchy[index], sub_ellipses=sub_ellipses)
 
     def _calc_pixel_length_mm(self, robot_ellipse, cam, circle_info):
         circle_size_mm = circle_info.get_size_by_id(robot_ellipse.get_id())
@@ -111,95 +205,140 @@ class SpecialEllipses:
     def _estimate_number_of_clusters(self, number_of_points, number_of_iterations):
         return round(number_of_points / number_of_iterations)
 
-    def _find_cluster_centers(self, ellipses, nr_of_clusters):                  #Mean shift clustering over nr_of_clusters
-        ellipse_centers = [ellipse.get_center() for ellipse in ellipses]
-        cluster_centers = self._find_N_cluster(ellipse_centers, nr_of_clusters)
-        return cluster_centers
-
-    def _auto_find_cluster_centers(self, ellipses):
-        ellipse_centers = [ellipse.get_center() for ellipse in ellipses]
-        current_nr_of_ellipses_in_range = 0
-        previous_nr_of_ellipses_in_range = -1
-        nr_of_clusters = 1
-        previous_cluster_centers = []
-        current_cluster_centers = []
-        while current_nr_of_ellipses_in_range > previous_nr_of_ellipses_in_range:
-            previous_nr_of_ellipses_in_range = current_nr_of_ellipses_in_range
-            current_nr_of_ellipses_in_range  = 0
-            previous_cluster_centers = current_cluster_centers
-            current_cluster_centers = self._find_N_cluster(ellipse_centers, nr_of_clusters)
-            print(current_cluster_centers)
-            for center in current_cluster_centers:
-                close_by_ellipse_centers = self._get_close_by_ellipses_from_center(ellipses, center)
-                current_nr_of_ellipses_in_range += len(close_by_ellipse_centers)
-            nr_of_clusters += 1
-        return previous_cluster_centers
-
-
-    def _find_N_cluster(self, points, nr_of_clusters):
-        model = KMeans(n_clusters = nr_of_clusters)
-        model.fit(points)
-        centers = model.cluster_centers_
-        return centers
-
-    def _get_close_by_ellipses_from_center(self, ellipses, center):
-        closest_ellipse = self._get_closest_ellipse_from_center(ellipses, center)
-        ellipses_in_range = self._get_ellipses_in_range_of_ellipse(ellipses, closest_ellipse)
-        return ellipses_in_range
-
-    def _get_closest_ellipse_from_center(self, ellipses, center):
-        closest_ellipse = ellipses[0]
-        closest_distance = EllipseHelpFunction.length_between_centers(ellipses[0].get_center(), center)
-        for ellipse in ellipses:
-            distance = EllipseHelpFunction.length_between_centers(ellipse.get_center(), center)
-            if distance < closest_distance:
-                closest_ellipse = ellipse
+    def _auto_find_clusters(self, ellipses, max_time = None):
+        #One pass instead of a KMeans per cluster count: every ellipse center is tested once against every super ellipse.
+        #The densest unclustered ellipse then takes all unclustered centers inside it, until no ellipse has an unclustered
+        #neighbour left. The cut is the ellipse itself, so it follows the size of the markers. Returns the member indices
+        #of every cluster. max_time (seconds) bounds the containment test: only the rows tested in time can seed a cluster
+        start_time = time.perf_counter()
+        if len(ellipses) == 0:
+            return []
+        centers = np.array([ellipse.get_center() for ellipse in ellipses], dtype=np.float64)
+        inside = self._centers_inside_super_ellipses(ellipses, centers, start_time, max_time)
+        density = inside.sum(axis=1)
+        clustered = np.zeros(len(ellipses), dtype=bool)
+        clusters = []
+        for seed in np.argsort(-density, kind='stable'):                          #N boolean row operations, cheap next to the test
+            if clustered[seed] == True:
+                continue
+            members = inside[seed] & ~clustered
+            if members.any() == False:                                          #Alone, all its neighbours are taken, or its row was not tested in time
+                continue
+            members[seed] = True
+            clustered |= members
+            clusters.append(np.flatnonzero(members))
+        return clusters
+
+    def _centers_inside_super_ellipses(self, ellipses, centers, start_time = None, max_time = None, chunk_size = 256):
+        #inside[i, j]: center j is inside the super ellipse of i, same test as EllipseHelpFunction.check_if_points_is_inside_ellipse.
+        #Built chunk_size rows at a time, so the temporaries stay at chunk_size x N; rows not reached within max_time stay False
+        widths = np.array([ellipse.get_width() for ellipse in ellipses])[:, np.newaxis]
+        heights = np.array([ellipse.get_height() for ellipse in ellipses])[:, np.newaxis]
+        rotations = np.radians([ellipse.get_rotation() for ellipse in ellipses])[:, np.newaxis]
+        inside = np.zeros((len(ellipses), len(ellipses)), dtype=bool)
+        for first in range(0, len(ellipses), chunk_size):
+            if max_time != None and time.perf_counter() - start_time > max_time:
+                break
+            rows = slice(first, first + chunk_size)
+            vectors = centers[np.newaxis, :, :] - centers[rows, np.newaxis, :]
+            distances = np.hypot(vectors[:, :, 0], vectors[:, :, 1])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                angles = np.arcsin(vectors[:, :, 1] / distances) + rotations[rows]
+                radii = (widths[rows] * heights[rows]) / np.sqrt((heights[rows]**2) * (np.sin(angles)**2) + (widths[rows]**2) * (np.cos(angles)**2))
+            inside[rows] = distances <= radii
+        np.fill_diagonal(inside, False)
+        return inside
+
+
+
+
+
+
+
+class RobotEllipseAccumulator:
+    #Running statistics of the robot ellipses seen over many frames. Every ellipse joins the cluster whose mean center it
+    #lies closest to, within the cluster's mean max size, or starts a new one. Per cluster only the count, the running
+    #means and variances (Welford), the ID votes and one set of sub ellipses per ID are kept, so memory does not grow
+    #with the number of frames
+    _fields = ('center_x', 'center_y', 'width', 'height', 'rotation', 'angle', 'distance')
+
+    def __init__(self):
+        self._clusters = []
+
+    def __len__(self):
+        return len(self._clusters)
+
+    def add(self, robot_ellipses):
+        for robot_ellipse in robot_ellipses:
+            values = self._get_values(robot_ellipse)
+            cluster = self._find_cluster(values)
+            if cluster == None:
+                cluster = { 'count': 0, 'mean': np.zeros(len(self._fields)), 'm2': np.zeros(len(self._fields)), 'id_votes': {}, 'sub_ellipses': {} }
+                self._clusters.append(cluster)
+            self._update_cluster(cluster, values, robot_ellipse)
+
+    def add_cluster(self, robot_ellipses):
+        #robot_ellipses already known to be one marker (e.g. a density cluster) go into one new cluster as they are
+        if len(robot_ellipses) == 0:
+            return
+        cluster = { 'count': 0, 'mean': np.zeros(len(self._fields)), 'm2': np.zeros(len(self._fields)), 'id_votes': {}, 'sub_ellipses': {} }
+        self._clusters.append(cluster)
+        for robot_ellipse in robot_ellipses:
+            self._update_cluster(cluster, self._get_values(robot_ellipse), robot_ellipse)
+
+    def _get_values(self, robot_ellipse):
+        center = robot_ellipse.get_center()
+        return np.array([center[0], center[1], robot_ellipse.get_width(), robot_ellipse.get_height(), robot_ellipse.get_rotation(),
+                         robot_ellipse.get_angle(), robot_ellipse.get_distance()], dtype=np.float64)
+
+    def _find_cluster(self, values):
+        closest_cluster = None
+        closest_distance = math.inf
+        for cluster in self._clusters:
+            mean = cluster['mean']
+            distance = math.hypot(values[0] - mean[0], values[1] - mean[1])
+            if distance < max(mean[2], mean[3]) and distance < closest_distance:
+                closest_cluster = cluster
                 closest_distance = distance
-        return closest_ellipse
-
-    def _get_ellipses_in_range_of_ellipse(self, ellipses, center_ellipse):
-        ellipses_in_range = []
-        super_ellipse = center_ellipse.get_super_ellipse()
-        for ellipse in ellipses:
-            if center_ellipse != ellipse:
-                if EllipseHelpFunction.check_if_points_is_inside_ellipse(super_ellipse, [ellipse.get_center()]) == True:
-                    ellipses_in_range.append(ellipse)
-        return ellipses_in_range
-
-    def _represent_cluster_centers_as_ellipses(self, ellipses, cluster_centers):
-        estimated_center_ellipses = []
-        for center in cluster_centers:
-            close_by_ellipse_centers = self._get_close_by_ellipses_from_center(ellipses, center)
-            average_robot_ellipse = self._create_average_robot_ellipse(close_by_ellipse_centers)
-            average_robot_ellipse.print()
-            estimated_center_ellipses.append(average_robot_ellipse)
-        return estimated_center_ellipses
-
-    def _create_average_robot_ellipse(self, ellipses):
-        nr_of_ellipses = len(ellipses)
-        center_list = [ellipse.get_center() for ellipse in ellipses]
-        average_center = [sum(center) / nr_of_ellipses for center in zip(*center_list)]
-        average_width = sum([ellipse.get_width() for ellipse in ellipses]) / nr_of_ellipses
-        average_height = sum([ellipse.get_height() for ellipse in ellipses]) / nr_of_ellipses
-        average_rotation = sum([ellipse.get_rotation() for ellipse in ellipses]) / nr_of_ellipses
-        average_angle = sum([ellipse.get_angle() for ellipse in ellipses]) / nr_of_ellipses
-        average_distance = sum([ellipse.get_distance() for ellipse in ellipses]) / nr_of_ellipses
-
-        average_super_ellipse = Ellipse([], average_center, average_width, average_height, average_rotation)
-        average_sub_ellipses = self._create_average_sub_ellipses(ellipses)
-        average_robot_ellipse = RobotEllipse(super_ellipse = average_super_ellipse, sub_ellipses = average_sub_ellipses)
-        average_robot_ellipse.set_angle(average_angle)
-        average_robot_ellipse.set_distance(average_distance)
+        return closest_cluster
+
+    def _update_cluster(self, cluster, values, robot_ellipse):
+        cluster['count'] += 1
+        delta = values - cluster['mean']
+        cluster['mean'] += delta / cluster['count']
+        cluster['m2'] += delta * (values - cluster['mean'])
+        robot_id = robot_ellipse.get_id()
+        cluster['id_votes'][robot_id] = cluster['id_votes'].get(robot_id, 0) + 1
+        if robot_id not in cluster['sub_ellipses']:                             #One example per ID is enough to represent it, None for marker ellipses
+            cluster['sub_ellipses'][robot_id] = robot_ellipse.sub_ellipses
+
+    def get_statistics(self):
+        statistics = []
+        for cluster in self._clusters:
+            variance = cluster['m2'] / (cluster['count'] - 1) if cluster['count'] > 1 else np.zeros(len(self._fields))
+            statistics.append({ 'count': cluster['count'],
+                                'id': self._dominant_id(cluster),
+                                'id_votes': dict(cluster['id_votes']),
+                                'mean': dict(zip(self._fields, cluster['mean'].tolist())),
+                                'variance': dict(zip(self._fields, variance.tolist())) })
+        return statistics
+
+    def _dominant_id(self, cluster):
+        return max(cluster['id_votes'].items(), key=operator.itemgetter(1))[0]
+
+    def get_robot_ellipses(self, nr_of_clusters = None):
+        #The nr_of_clusters most often seen clusters (all when None) as averaged robot ellipses
+        clusters = sorted(self._clusters, key=lambda cluster: cluster['count'], reverse=True)
+        if nr_of_clusters != None:
+            clusters = clusters[:nr_of_clusters]
+        return [self._create_average_robot_ellipse(cluster) for cluster in clusters]
+
+    def _create_average_robot_ellipse(self, cluster):
+        center_x, center_y, width, height, rotation, angle, distance = cluster['mean'].tolist()
+        average_super_ellipse = Ellipse([], (center_x, center_y), width, height, rotation)
+        dominant_id = self._dominant_id(cluster)
+        average_sub_ellipses = cluster['sub_ellipses'][dominant_id]
+        average_robot_ellipse = RobotEllipse(super_ellipse = average_super_ellipse, sub_ellipses = average_sub_ellipses, id = dominant_id)
+        average_robot_ellipse.set_angle(angle)
+        average_robot_ellipse.set_distance(distance)
         return average_robot_ellipse
-
-    def _create_average_sub_ellipses(self, ellipses):
-        id_map = {}
-        for ellipse in ellipses:
-            if ellipse.get_id() not in id_map:
-                id_map[ellipse.get_id()] = 0
-            id_map[ellipse.get_id()] += 1
-        dominant_id = max(id_map.items(), key=operator.itemgetter(1))[0]
-        for ellipse in ellipses:
-            if ellipse.get_id() == dominant_id:
-                return ellipse.get_sub_ellipses()
-        return ellipses[0].get_sub_ellipses()
@@ -0,0 +1,198 @@
+import numpy as np
+import threading
+import collections
+import time
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+class StageTimers:
+    #Rolling latencies per camera and stage. Disabled, stage() hands out one shared do-nothing timer, so instrumented code
+    #costs a method call per stage
+    def __init__(self, enabled = True, window = 1000, prefix = 'robot_tracking'):
+        self._enabled = enabled
+        self._window = window                                                   #Latest durations kept per camera and stage for the quantiles
+        self._prefix = prefix
+        self._durations = {}                                                    #(cam name, stage) -> { 'recent': deque, 'count': int, 'sum': float }
+        self._imported = {}                                                     #(cam name, stage) -> (count, sum) of the last import_durations
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __getstate__(self):                                                     #A copy (e.g. in a camera worker process) keeps the settings and starts empty
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_durations'] = {}
+        state['_imported'] = {}
+        state['_server'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def is_enabled(self):
+        return self._enabled
+
+    def set_enabled(self, enabled):
+        self._enabled = enabled
+
+    def stage(self, cam_name, stage):
+        if not self._enabled:
+            return _NO_TIMER
+        return _StageTimer(self, cam_name, stage)
+
+    def record(self, cam_name, stage, seconds):
+        with self._lock:
+            durations = self._get_durations(cam_name, stage)
+            durations['recent'].append(seconds)
+            durations['count'] += 1
+            durations['sum'] += seconds
+
+    def _get_durations(self, cam_name, stage):
+        durations = self._durations.get((cam_name, stage))
+        if durations == None:
+            durations = { 'recent': collections.deque(maxlen = self._window), 'count': 0, 'sum': 0.0 }
+            self._durations[(cam_name, stage)] = durations
+        return durations
+
+    def export_durations(self, cam_name):
+        #{ stage: (count, sum, latest durations) } of cam_name, for import_durations of the StageTimers in another process
+        with self._lock:
+            return { stage: (durations['count'], durations['sum'], list(durations['recent']))
+                     for (name, stage), durations in self._durations.items() if name == cam_name }
+
+    def import_durations(self, cam_name, exported):
+        #Records what the exporting copy timed since the last import, so importing the same export twice changes nothing and
+        #a skipped export only loses the durations that already left its window
+        with self._lock:
+            for stage, (count, total, recent) in exported.items():
+                last_count, last_total = self._imported.get((cam_name, stage), (0, 0.0))
+                if count <= last_count:
+                    continue
+                durations = self._get_durations(cam_name, stage)
+                durations['recent'].extend(recent[max(len(recent) - (count - last_count), 0):])
+                durations['count'] += count - last_count
+                durations['sum'] += total - last_total
+                self._imported[(cam_name, stage)] = (count, total)
+
+    def reset(self):
+        with self._lock:
+            self._durations = {}                                                #_imported stays, the copies keep counting from there
+
+    def get_statistics(self, cam_name = None):
+        #{ cam name: { stage: { 'count', 'sum', 'p50', 'p95', 'p99' } } } in seconds, quantiles over the last window durations
+        with self._lock:
+            snapshot = [(key, list(durations['recent']), durations['count'], durations['sum']) for key, durations in self._durations.items()]
+        statistics = {}
+        for (name, stage), recent, count, total in snapshot:
+            if cam_name != None and name != cam_name:
+                continue
+            p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+            statistics.setdefault(name, {})[stage] = { 'count': count, 'sum': total, 'p50': float(p50), 'p95': float(p95), 'p99': float(p99) }
+        return statistics
+
+    def to_prometheus(self):
+        #Text exposition format, one summary with camera and stage labels
+        metric = self._prefix + '_stage_seconds'
+        lines = ['# HELP ' + metric + ' Duration of each stage of find_robots per camera.', '# TYPE ' + metric + ' summary']
+        statistics = self.get_statistics()
+        for cam_name in sorted(statistics):
+            for stage in sorted(statistics[cam_name]):
+                stage_statistics = statistics[cam_name][stage]
+                labels = 'camera="' + self._escape(cam_name) + '",stage="' + self._escape(stage) + '"'
+                for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+                    lines.append(metric + '{' + labels + ',quantile="' + quantile + '"} ' + repr(float(stage_statistics[key])))
+                lines.append(metric + '_sum{' + labels + '} ' + repr(float(stage_statistics['sum'])))
+                lines.append(metric + '_count{' + labels + '} ' + str(stage_statistics['count']))
+        return '\n'.join(lines) + '\n'
+
+    def _escape(self, label):
+        return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def write_prometheus(self, path):
+        #Written next to path and renamed, so a collector reading the file (e.g. node_exporter's textfile) never sees half of it
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(temporary_path, path)
+
+    def serve_prometheus(self, port = 9464, address = '127.0.0.1'):
+        #Serves the snapshot on http://address:port/metrics from a daemon thread
+        if self._server != None:
+            return self._server
+        timers = self
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = timers.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target = self._server.serve_forever, daemon = True).start()
+        return self._server
+
+    def stop_serving(self):
+        if self._server != None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+
+
+
+
+
+class _StageTimer:
+    def __init__(self, timers, cam_name, stage):
+        self._timers = timers
+        self._cam_name = cam_name
+        self._stage = stage
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._timers.record(self._cam_name, self._stage, time.perf_counter() - self._start)
+        return False
+
+
+
+
+
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+
+
+
+
+
+
+
+
+
+
+
+#Nothing
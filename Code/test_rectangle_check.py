@@ -0,0 +1,38 @@
+import cv2
+import numpy as np
+
+from EllipseDetection import EllipseDetection, RobotEllipseRules
+
+
+
+def _detect_form(draw):
+    image = np.full((600, 600), 255, np.uint8)
+    draw(image)
+    ellipses = [ellipse for ellipse in EllipseDetection(125, edge_retention = 'full').detect(image) if ellipse.max_size() > 40]
+    assert len(ellipses) == 1
+    return ellipses[0]
+
+def _rotated_rectangle(angle):
+    def draw(image):
+        corners = cv2.boxPoints(((300, 300), (240, 140), angle)).astype(np.int32)
+        cv2.fillPoly(image, [corners], 0)
+    return draw
+
+
+def test_rectangles_are_rejected():
+    rules = RobotEllipseRules(rectangle_check = True)
+    assert rules.not_rectangle(None, _detect_form(lambda image: cv2.rectangle(image, (200, 225), (400, 375), 0, -1))) == False
+    assert rules.not_rectangle(None, _detect_form(lambda image: cv2.rectangle(image, (210, 210), (390, 390), 0, -1))) == False
+    assert rules.not_rectangle(None, _detect_form(_rotated_rectangle(30))) == False
+
+def test_ellipses_are_kept():
+    rules = RobotEllipseRules(rectangle_check = True)
+    assert rules.not_rectangle(None, _detect_form(lambda image: cv2.circle(image, (300, 300), 90, 0, -1))) == True
+    assert rules.not_rectangle(None, _detect_form(lambda image: cv2.ellipse(image, ((300, 300), (240, 140), 0), 0, -1))) == True
+    assert rules.not_rectangle(None, _detect_form(lambda image: cv2.ellipse(image, ((300, 300), (240, 140), 30), 0, -1))) == True
+
+def test_released_edges_are_kept():
+    rules = RobotEllipseRules(rectangle_check = True)
+    form = _detect_form(_rotated_rectangle(30))
+    form.release_edge_pixels()
+    assert rules.not_rectangle(None, form) == True